@@ -10,7 +10,7 @@ from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_v1_5
 from hashlib import md5
 from base64 import b64encode
-import math, logging
+import asyncio, math, os, logging
 
 from bilibili_toolman.bilisession.web import BiliSession as BiliWebSession
 from bilibili_toolman.bilisession.common import (
@@ -18,10 +18,13 @@ from bilibili_toolman.bilisession.common import (
     JSONResponse,
     LoginException,
     ReprExDict,
-    file_manager,
     check_file,
 )
+from bilibili_toolman.bilisession.common.bandwidth import BandwidthGovernor, governor
+from bilibili_toolman.bilisession.common.digest import OrderedDigest
 from bilibili_toolman.bilisession.common.submission import Submission
+from bilibili_toolman.bilisession.common.transport import StallWatchdog
+from bilibili_toolman.bilisession.common.upload import UploadEngine, UploadJob, UploadLink
 
 logger = logging.getLogger("ClientSession")
 
@@ -94,6 +97,72 @@ class SignedDict(dict):
         _sorted = self.sorted
         return {**_sorted, "sign": Crypto.sign(_sorted)}
 
+class MultipartBody:
+    """multipart/form-data body of a part,streamed from the file piece by piece
+
+    Sized up front so `requests` sends it with a Content-Length,and iterated over once per
+    attempt; the part's MD5 is computed while its bytes go out,hence sent as the last field.
+    Pieces are also fed to the whole-file `OrderedDigest`, which holds those ahead of its
+    frontier only within `OrderedDigest.HOLD_SHARE` of the memory budget, so a worker's
+    memory stays at about one piece whatever order the parts go out in.
+    """
+
+    BOUNDARY_PREFIX = "----toolman"
+
+    def __init__(self, chunk: "ClientUploadChunk", fields: dict, filename: str) -> None:
+        """
+        Args:
+            chunk (ClientUploadChunk): 所上传的分块
+            fields (dict): 文件之前的表单字段
+            filename (str): 文件名
+        """
+        self.chunk, self.md5 = chunk, md5()
+        self.boundary = self.BOUNDARY_PREFIX + os.urandom(12).hex()
+        self.head = b"".join(self._field(name, value) for name, value in fields.items())
+        self.head += self._header(
+            'name="file"; filename="%s"' % self._quote(filename), "application/octet-stream"
+        )
+
+    @staticmethod
+    def _quote(value: str) -> str:
+        """escapes a header parameter value the way browsers (and `urllib3`) do"""
+        value = value.replace("\\", "\\\\").replace('"', "%22")
+        return "".join(c if ord(c) >= 0x20 or c == "\x1b" else "%%%02X" % ord(c) for c in value)
+
+    def _header(self, disposition: str, content_type: str = None) -> bytes:
+        header = "--%s\r\nContent-Disposition: form-data; %s\r\n" % (self.boundary, disposition)
+        if content_type:
+            header += "Content-Type: %s\r\n" % content_type
+        return (header + "\r\n").encode()
+
+    def _field(self, name: str, value) -> bytes:
+        return self._header('name="%s"' % self._quote(name)) + str(value).encode() + b"\r\n"
+
+    def _tail(self, md5_: str) -> bytes:
+        return b"\r\n" + self._field("md5", md5_) + ("--%s--\r\n" % self.boundary).encode()
+
+    @property
+    def content_type(self) -> str:
+        return "multipart/form-data; boundary=%s" % self.boundary
+
+    def __len__(self):
+        return len(self.head) + len(self.chunk) + len(self._tail("0" * 32))
+
+    def __iter__(self):
+        yield self.head
+        chunk, fed = self.chunk, None
+        start = chunk.start
+        for piece in chunk:
+            self.md5.update(piece)
+            if chunk.digest:
+                fed = chunk.digest.feed(start, piece)
+            start += len(piece)
+            yield piece
+        if fed:
+            fed.wait()  # keeps the hashing thread from falling behind
+        yield self._tail(self.md5.hexdigest())
+
+
 class ClientUploadChunk(FileIterator):
     url_endpoint: str
     params: dict
@@ -101,28 +170,33 @@ class ClientUploadChunk(FileIterator):
     files: dict
     cookies: dict
     session: Session
+    digest: OrderedDigest = None
+    """whole-file digest this part is fed to as it's read"""
 
     def upload_via_session(self, session=None):
-        chunk_bytes = self.to_bytes()
-        md5 = Crypto.md5(chunk_bytes)
-        for retries in range(1, BiliSession.RETRIES_UPLOAD_ID + 1):
-            try:
-                resp = (session or self.session).post(
-                    self.url_endpoint,
-                    params=self.params,
-                    headers=self.headers,
-                    files={
-                        **self.files,
-                        "md5": (None, md5),
-                        "file": (self.path, chunk_bytes, "application/octet-stream"),
-                    },
-                    cookies=self.cookies,
-                )
-                assert resp.json()["OK"] == 1, resp.text
-                return True
-            except Exception as e:
-                logger.warning("第 %s 次重试时：%s" % (retries, e))
-        return False
+        """sends this part once,retries are up to the upload engine"""
+        governor.acquire(governor.UP, len(self), self.job.priority)
+        body = MultipartBody(
+            self, {name: value for name, (_, value) in self.files.items()}, str(self.path)
+        )
+        resp = (session or self.session).post(
+            self.session._rewrite_url(self.url_endpoint),
+            params=self.params,
+            headers={**self.headers, "Content-Type": body.content_type},
+            data=StallWatchdog(
+                body, self.session.MIN_UPLOAD_THROUGHPUT, self.session.TIMEOUTS["part"][1]
+            ),
+            cookies=self.cookies,
+            timeout=self.session.TIMEOUTS["part"],
+        )
+        assert resp.json()["OK"] == 1, resp.text
+        return True
+
+    async def upload_async(self, engine: UploadEngine, link: UploadLink = None):
+        self.cancelled = False
+        return await engine.run_in_executor(
+            self.upload_via_session, self.session._link_session(link), on_cancel=self.cancel
+        )
 
 class BiliSession(BiliWebSession):
     """哔哩哔哩上传助手 API"""
@@ -159,6 +233,10 @@ class BiliSession(BiliWebSession):
     def mid(self):
         return self.login_tokens["mid"]
 
+    @property
+    def _uploader(self) -> str:
+        return str(self.login_tokens.get("mid", ""))
+
     @property
     def access_token(self):
         return self.login_tokens["access_token"]
@@ -181,6 +259,19 @@ class BiliSession(BiliWebSession):
             },
         )
 
+    async def _handshake(self, path: str, exclude=(), upcdn: str = None) -> Tuple[dict, str]:
+        loop = asyncio.get_running_loop()
+        preupload_token = (await loop.run_in_executor(None, self._preupload)).json()
+        return preupload_token, preupload_token["url"]
+
+    async def _handshake_with_retry(self, path: str, exclude=()) -> Tuple[dict, str]:
+        return await self.upload_retry_policy.run_async(
+            self._handshake, path, key="preupload:%s" % self.TYPE
+        )
+
+    async def _warm_connections(self, endpoint: str):
+        return 0  # parts are sent with `requests`,whose pools can't be filled ahead of time
+
     def _upload_cover(self, image_binary: bytes, image_mime: str):
         return self.post(
             "https://member.bilibili.com/x/vu/client/cover/up",
@@ -404,21 +495,35 @@ class BiliSession(BiliWebSession):
             raise LoginException(resp, e)
         return resp
 
-    def UploadVideo(self, path: str) -> Tuple[str, None]:
-        """上传视频
+    async def UploadVideoAsync(
+        self, path: str, weight: float = 1, priority: int = BandwidthGovernor.PRIORITY_NORMAL
+    ) -> Tuple[str, None]:
+        """上传视频 (asyncio)，可并发上传多个视频
 
         Args:
-            path (str): 视频文件路径
+            path (str): 视频文件路径，亦可为 URL (http(s)://，s3://) 或 `UploadSource`
+            weight (float, optional): 并发上传时的调度权重. Defaults to 1.
+            priority (int, optional): 带宽限速时的优先级，越小越优先. Defaults to PRIORITY_NORMAL.
 
         Returns:
             Tuple[str,None]: [远端 URI,None]
         """
+        streamed = await self._take_stream(path)
+        if streamed:
+            return streamed
         path, basename, size = check_file(path)
-        preupload_token = self._preupload().json()
+        loop = asyncio.get_running_loop()
+        index_key, indexed = await self._take_indexed(path)
+        if indexed:
+            return indexed
+        handshake = await self._take_handshake(path) or await self._handshake(path)
+        preupload_token = handshake[0]
         # preprae the chunks then uploads them
         chunksize = self.UPLOAD_CHUNK_SIZE
         chunkcount = math.ceil(size / chunksize)
-        file_manager.open(path)
+        job = UploadJob(path, weight, priority)
+        job.open()
+        digest = OrderedDigest(path, size, job.file_manager)
         logger.debug("上传分块: %s" % chunkcount)
         logger.debug("分块大小: %s B" % chunksize)
 
@@ -435,19 +540,37 @@ class BiliSession(BiliWebSession):
                     "chunks": (None, chunkcount),
                 }
                 chunk.cookies = {"PHPSESSID": preupload_token["filename"]}
+                chunk.digest = digest
                 yield chunk
 
-        self._upload_chunks_to_endpoint_blocking(iter_chunks())
-        # recalulating md5
-        md5_ = Crypto.iterable_md5(FileIterator(path, 0, size))
-        file_manager.close(path)
+        try:
+            await self._upload_chunks_to_endpoint(job.extend(iter_chunks()))
+            # hashed while uploading,only parts it never saw are read again
+            md5_ = await loop.run_in_executor(None, digest.hexdigest)
+        finally:
+            digest.close()
+            job.close()
         logger.debug("MD5: %s" % md5_)
         # finalizing upload
-        post_r = self._post_complete_upload(
-            preupload_token["complete"], size, basename, md5_, chunkcount
+        post_r = await loop.run_in_executor(
+            None,
+            self._post_complete_upload,
+            preupload_token["complete"],
+            size,
+            basename,
+            md5_,
+            chunkcount,
         )
         logger.info("远端结点： %s" % preupload_token.get("filename", "<failed>"))
-        logger.debug("上传完毕： %s" % ReprExDict(post_r.json()))
+        try:
+            completed = post_r.json()
+        except ValueError:
+            completed = {"HTTP": post_r.status_code, "text": post_r.text}
+        logger.debug("上传完毕： %s" % ReprExDict(completed))
+        if post_r.ok and completed.get("OK") == 1:
+            self._record_indexed(index_key, (preupload_token["filename"], None))
+        else:
+            logger.warning("上传未能完成，不记入上传索引：%s" % ReprExDict(completed))
         return preupload_token["filename"], None
 
     # endregion
@@ -2,15 +2,16 @@
 from json import JSONDecodeError
 import os
 from functools import wraps
-from threading import Lock
+from threading import Lock, Thread
 from typing import Tuple
 from requests import Session
 from io import IOBase
-from queue import Queue
-import time
+import asyncio, mmap, queue, time
 
 from requests.models import Response
 
+from bilibili_toolman.bilisession.common.sources import UploadSource, open_source
+
 # region Wrappers
 def JSONResponse(classfunc) -> dict:
     """Decodes `Response`s content to JSON dict"""
@@ -45,69 +46,253 @@ class ReprExDict(dict):
 
 
 class FileManager(dict):
-    """single-instance threadsafe file IO manager"""
+    """threadsafe file IO manager, one instance is owned by every `UploadJob`
+
+    Modes:
+        locked : one shared stream per path, `seek()` & `read()` under a lock
+        pread  : positional reads with `os.pread`, concurrent readers never wait on each other
+        mmap   : zero-copy `memoryview` slices of a read-only `mmap`
+
+    Paths may also be `UploadSource`s, which are read by range whatever the mode.
+
+    Page cache : where `os.posix_fadvise` exists, files are opened with a SEQUENTIAL hint,
+    ranges about to be read are hinted WILLNEED (`willneed`) and ranges no longer needed
+    DONTNEED (`dontneed`), so huge uploads neither starve on read-ahead nor evict everything else.
+
+    Prefetch : with `prefetch` set, WILLNEED ranges are also read ahead by a background thread,
+    at most `PREFETCH_DEPTH` ranges ahead, so disk reads overlap network sends even where the
+    kernel ignores hints (e.g. network filesystems)
+    """
 
     CHUNK_SIZE = 2**16
 
-    def __init__(self) -> None:
+    MODE_LOCKED = "locked"
+    MODE_PREAD = "pread"
+    MODE_MMAP = "mmap"
+    MODE = MODE_PREAD if hasattr(os, "pread") else MODE_LOCKED
+    """Default mode. `os.pread` is unavailable on Windows"""
+
+    PREFETCH = False
+    PREFETCH_DEPTH = 2
+    PREFETCH_IDLE = 5
+    """Seconds the prefetch thread waits for work before leaving"""
+
+    def __init__(self, mode: str = None, prefetch: bool = None) -> None:
         super().__init__()
         self.lock = Lock()
+        self.mode = mode or self.MODE
+        if self.mode == self.MODE_PREAD and not hasattr(os, "pread"):
+            self.mode = self.MODE_LOCKED
+        self.prefetch = self.PREFETCH if prefetch is None else prefetch
+        self._prefetch_queue = queue.Queue(self.PREFETCH_DEPTH)
+        self._prefetch_thread: Thread = None
 
     def open(self, path):
-        self.lock.acquire()  # preventing multipule instances from accessing all at once
-        if not path in self or self[path]["stream"].closed:
-            self[path] = {
-                "stream": open(path, "rb"),
-                "read": 0,
-                "length": os.stat(path).st_size,
-            }
-        self.lock.release()
+        if isinstance(path, UploadSource):
+            path.open()
+            with self.lock:
+                self.setdefault(path, {"source": path, "read": 0, "length": path.size})
+            return
+        with self.lock:  # preventing multipule instances from accessing all at once
+            if not path in self or self[path]["stream"].closed:
+                stream = open(path, "rb")
+                self[path] = {
+                    "stream": stream,
+                    "read": 0,
+                    "length": os.fstat(stream.fileno()).st_size,
+                }
+                self._advise(stream.fileno(), 0, 0, "POSIX_FADV_SEQUENTIAL")
+                if self.mode == self.MODE_MMAP and self[path]["length"]:
+                    mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+                    if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                        mapped.madvise(mmap.MADV_SEQUENTIAL)
+                    self[path]["mmap"], self[path]["view"] = mapped, memoryview(mapped)
 
     def close(self, path):
-        stream: IOBase = self[path]["stream"]
+        entry = self.pop(path)
+        if "source" in entry:
+            entry["source"].close()
+            return
+        try:
+            if "view" in entry:
+                entry["view"].release()
+                entry["mmap"].close()
+        except BufferError:
+            pass  # slices are still referenced elsewhere,the map is freed once they're gone
+        stream: IOBase = entry["stream"]
         stream.close()
-        del self[path]
 
     def read(self, path, start, end):
+        """reads [start,end) of `path`. Returns `memoryview` in mmap mode, `bytes` otherwise"""
         if not path in self:
             self.open(path)  # open for new IO handler
-        stream: IOBase = self[path]["stream"]
-        self.lock.acquire()  # same as open
-        stream.seek(start)
+        entry = self[path]
         length = end - start
-        self[path]["read"] += length
-        self.lock.release()
-        return stream.read(length)
+        if "source" in entry:
+            data = entry["source"].read(start, end)
+        elif "view" in entry:
+            data = entry["view"][start:end]
+        elif self.mode == self.MODE_PREAD:
+            data = os.pread(entry["stream"].fileno(), length, start)
+        else:
+            stream: IOBase = entry["stream"]
+            with self.lock:  # same as open
+                stream.seek(start)
+                data = stream.read(length)
+        self.account(path, length)
+        return data
+
+    @staticmethod
+    def _advise(fd, start, length, advice: str):
+        if hasattr(os, "posix_fadvise") and hasattr(os, advice):
+            try:
+                os.posix_fadvise(fd, start, length, getattr(os, advice))
+            except OSError:
+                pass  # only a hint
+
+    def willneed(self, path, start, end):
+        """hints that [start,end) of `path` will be read soon,reading it ahead with `prefetch` set"""
+        entry = self.get(path)
+        if entry is None or "stream" not in entry or entry["stream"].closed:
+            return
+        self._advise(entry["stream"].fileno(), start, end - start, "POSIX_FADV_WILLNEED")
+        if self.prefetch:
+            self._prefetch(path, start, end)
+
+    def dontneed(self, path, start, end):
+        """hints that [start,end) of `path` won't be read again,so its pages may be evicted"""
+        entry = self.get(path)
+        if entry is None or "stream" not in entry or entry["stream"].closed:
+            return
+        self._advise(entry["stream"].fileno(), start, end - start, "POSIX_FADV_DONTNEED")
+
+    def _prefetch(self, path, start, end):
+        try:
+            self._prefetch_queue.put_nowait((path, start, end))
+        except queue.Full:
+            return  # far enough ahead already
+        with self.lock:
+            if self._prefetch_thread is None or not self._prefetch_thread.is_alive():
+                self._prefetch_thread = Thread(
+                    target=self._prefetch_worker, name="Prefetch", daemon=True
+                )
+                self._prefetch_thread.start()
+
+    def _prefetch_worker(self):
+        """reads queued ranges into the page cache through a scratch buffer"""
+        scratch = memoryview(bytearray(self.CHUNK_SIZE * 16))
+        while True:
+            try:
+                path, start, end = self._prefetch_queue.get(timeout=self.PREFETCH_IDLE)
+            except queue.Empty:
+                return
+            entry = self.get(path)
+            try:
+                if entry is None or entry["stream"].closed:
+                    continue
+                if "view" in entry:
+                    # touching one byte per page faults the mapping in
+                    for offset in range(start, min(end, entry["length"]), mmap.PAGESIZE):
+                        entry["view"][offset]
+                    continue
+                fd = os.dup(entry["stream"].fileno())  # own offset,and survives `close()`
+                with open(fd, "rb", buffering=0) as stream:
+                    stream.seek(start)
+                    while start < end:
+                        length = stream.readinto(scratch[: min(len(scratch), end - start)])
+                        if not length:
+                            break
+                        start += length
+            except (OSError, ValueError):
+                continue  # closed meanwhile
+
+    def account(self, path, length):
+        """counts `length` bytes as read for `path`,for reads that bypassed `read()` (e.g. sendfile)"""
+        with self.lock:
+            if path in self:
+                self[path]["read"] += length
 
 
 class FileIterator:
     """__iter__ impl for `FileManager` with i/o usage monitoring"""
 
-    tell = None
-
-    def __init__(self, path, start, end) -> None:
+    def __init__(self, path, start, end, manager: FileManager = None) -> None:
         self.path, self.start, self.end = path, start, end
+        self.file_manager = manager or file_manager
+        self.cancelled = False
 
     def __getattr__(self, name):  # defining fallback
+        if name in {"read", "tell"}:
+            # not file-like,so `requests` sizes us with `len()` and iterates over us
+            raise AttributeError(name)
         return {}
 
+    @property
+    def piece(self) -> int:
+        """bytes read at a time. `UploadSource`s are read in fewer,larger ranges"""
+        return getattr(self.path, "PIECE_SIZE", FileManager.CHUNK_SIZE)
+
+    @property
+    def ready(self) -> bool:
+        """whether this range can be read right away"""
+        ready = getattr(self.path, "ready", None)
+        return ready(self.start, self.end) if ready else True
+
+    async def wait_ready(self):
+        """waits until this range can be read,for sources still being written"""
+        wait = getattr(self.path, "wait_async", None)
+        if wait:
+            await wait(self.start, self.end)
+
+    def cancel(self):
+        """stops iterations in progress at their next piece,e.g. a send running in a thread
+        that's no longer wanted"""
+        self.cancelled = True
+
     def __iter__(self):
-        start = self.start
-        for start in range(self.start, self.end, FileManager.CHUNK_SIZE):
-            yield file_manager.read(
-                self.path, start, min(self.end, start + FileManager.CHUNK_SIZE)
+        start, piece = self.start, self.piece
+        for start in range(self.start, self.end, piece):
+            if self.cancelled:
+                raise IOError("已取消")
+            yield self.file_manager.read(self.path, start, min(self.end, start + piece))
+        if start + piece < self.end:
+            yield self.file_manager.read(self.path, start, self.end)
+
+    async def iter_async(self):
+        """async variant of `__iter__`, reads are offloaded to the default executor"""
+        loop = asyncio.get_running_loop()
+        piece = self.piece
+        for start in range(self.start, self.end, piece):
+            yield await loop.run_in_executor(
+                None,
+                self.file_manager.read,
+                self.path,
+                start,
+                min(self.end, start + piece),
             )
-        if start + FileManager.CHUNK_SIZE < self.end:
-            yield file_manager.read(self.path, start, self.end)
 
     def __len__(self):
         return self.end - self.start
 
     def to_bytes(self):
-        buffer = bytearray()
-        for chunk in self:
-            buffer.extend(chunk)
-        return buffer
+        """reads the whole range at once. Zero-copy `memoryview` in mmap mode"""
+        return self.file_manager.read(self.path, self.start, self.end)
+
+    @property
+    def footprint(self) -> int:
+        """bytes held in memory while this range is being sent,one piece when streamed"""
+        return min(len(self), self.piece)
+
+
+def parse_size(size) -> float:
+    """'512K' / '10M' / '1G' / '1GB' / 1024 -> bytes"""
+    if isinstance(size, (int, float)):
+        return float(size)
+    size = size.strip().upper().rstrip("B")
+    units = {"K": 2**10, "M": 2**20, "G": 2**30}
+    if size[-1:] in units:
+        return float(size[:-1]) * units[size[-1]]
+    return float(size)
 
 
 def get_timestamp() -> int:
@@ -116,11 +301,23 @@ def get_timestamp() -> int:
 
 
 def check_file(path) -> Tuple[str, str, int]:
-    """checks if targeted path is a file then returns its Full Path, Basename, Size (in Bytes)"""
+    """checks if targeted path is a file then returns its Full Path, Basename, Size (in Bytes)
+
+    URLs & `UploadSource`s are returned as sources (see `open_source`)"""
+    path = open_source(path)
+    if isinstance(path, UploadSource):
+        return path, path.name, path.size
     assert os.path.isfile(path), "%s 不存在，检查视频源配置！（如：yt-dlp配置了时间窗口）" % path
     size = os.stat(path).st_size
     return path, os.path.basename(path), size
 
 
-chunk_queue = Queue()
+def file_key(path) -> str:
+    """identifies the content of `path` (a local path or an `UploadSource`) in its current state"""
+    if isinstance(path, UploadSource):
+        return path.key
+    stat = os.stat(path)
+    return "%s|%d|%d" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
 file_manager = FileManager()
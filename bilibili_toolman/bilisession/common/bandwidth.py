@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Process-wide bandwidth governor shared by downloads & uploads"""
+from threading import Lock
+from typing import List, Tuple
+import asyncio, datetime, time, logging
+
+from bilibili_toolman.bilisession.common import parse_size
+
+logger = logging.getLogger("Bandwidth")
+
+
+def parse_rate(rate) -> float:
+    """'512K' / '10M' / '1G' / 1024 -> B/s,None / 0 / '' for unlimited"""
+    if not rate:
+        return None
+    if isinstance(rate, str):
+        rate = rate.strip().upper().rstrip("/S")
+    return parse_size(rate)
+
+
+class TokenBucket:
+    """Token bucket that may go into debt,so requests larger than `burst` still pass"""
+
+    def __init__(self, rate: float = None, burst: float = None) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def refill(self, rate: float):
+        now = time.monotonic()
+        if rate:
+            burst = self.burst or rate
+            self.tokens = min(self.tokens + (now - self.updated) * rate, burst)
+        self.updated = now
+
+    def take(self, nbytes: int, rate: float) -> float:
+        """takes `nbytes` if the bucket isn't in debt,else returns seconds to wait"""
+        self.refill(rate)
+        if self.tokens > 0 or not rate:
+            self.tokens -= nbytes
+            return 0
+        return -self.tokens / rate
+
+
+class BandwidthGovernor:
+    """Token-bucket limits on upload & download bandwidth,shared by every transfer of the process
+
+    Priority classes : a transfer waits while any transfer of a higher class (smaller number)
+    is waiting in the same direction, so e.g. uploads due soon get bandwidth first.
+
+    Schedule : (start, end, up, down) entries override the default limits between two
+    times of day, e.g. `("09:00", "18:00", "1M", "10M")`. `end` may be past midnight.
+    """
+
+    UP = "up"
+    DOWN = "down"
+
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
+
+    MAX_WAIT = 1
+    """Waits are broken into slices this long,so limits changing meanwhile take effect"""
+
+    def __init__(self, up=None, down=None) -> None:
+        """
+        Args:
+            up, down (optional): 上传/下载带宽上限 (B/s，或如 '10M'). Defaults to None (不限).
+        """
+        self.lock = Lock()
+        self.limits = {self.UP: parse_rate(up), self.DOWN: parse_rate(down)}
+        self.schedule: List[Tuple[int, int, float, float]] = []
+        self.buckets = {self.UP: TokenBucket(), self.DOWN: TokenBucket()}
+        self.waiting = {self.UP: dict(), self.DOWN: dict()}
+        """Transfers waiting per direction,per priority class"""
+
+    def set_limits(self, up=None, down=None):
+        self.limits = {self.UP: parse_rate(up), self.DOWN: parse_rate(down)}
+
+    def add_schedule(self, start: str, end: str, up=None, down=None):
+        """limits bandwidth to `up` & `down` between `start` and `end` (HH:MM) every day"""
+
+        def minutes(hhmm):
+            h, m = hhmm.split(":")
+            return int(h) * 60 + int(m)
+
+        self.schedule.append((minutes(start), minutes(end), parse_rate(up), parse_rate(down)))
+
+    def parse_schedule(self, schedule: str):
+        """parses `HH:MM-HH:MM=up/down` entries separated by `,` e.g. `09:00-18:00=1M/10M,18:00-09:00=/`"""
+        for entry in filter(None, schedule.split(",")):
+            span, rates = entry.split("=")
+            start, end = span.split("-")
+            up, down = (rates.split("/") + [""])[:2]
+            self.add_schedule(start.strip(), end.strip(), up or None, down or None)
+
+    def rate(self, direction: str) -> float:
+        """current limit of `direction` in B/s,None for unlimited"""
+        if self.schedule:
+            now = datetime.datetime.now()
+            minute = now.hour * 60 + now.minute
+            for start, end, up, down in self.schedule:
+                if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                    return up if direction == self.UP else down
+        return self.limits[direction]
+
+    def _try(self, direction: str, nbytes: int, priority: int) -> float:
+        """takes `nbytes` if allowed now,else returns seconds to wait"""
+        rate = self.rate(direction)
+        if not rate:
+            return 0
+        with self.lock:
+            waiting = self.waiting[direction]
+            if any(count for p, count in waiting.items() if p < priority):
+                return min(nbytes / rate, self.MAX_WAIT)
+            return min(self.buckets[direction].take(nbytes, rate), self.MAX_WAIT)
+
+    def _wait(self, direction, priority, delta):
+        with self.lock:
+            waiting = self.waiting[direction]
+            waiting[priority] = waiting.get(priority, 0) + delta
+
+    def acquire(self, direction: str, nbytes: int, priority: int = PRIORITY_NORMAL):
+        """blocks until `nbytes` may be transferred in `direction`"""
+        delay = self._try(direction, nbytes, priority)
+        if not delay:
+            return
+        self._wait(direction, priority, 1)
+        try:
+            while delay:
+                time.sleep(delay)
+                delay = self._try(direction, nbytes, priority)
+        finally:
+            self._wait(direction, priority, -1)
+
+    async def acquire_async(self, direction: str, nbytes: int, priority: int = PRIORITY_NORMAL):
+        """`acquire` for coroutines"""
+        delay = self._try(direction, nbytes, priority)
+        if not delay:
+            return
+        self._wait(direction, priority, 1)
+        try:
+            while delay:
+                await asyncio.sleep(delay)
+                delay = self._try(direction, nbytes, priority)
+        finally:
+            self._wait(direction, priority, -1)
+
+
+governor = BandwidthGovernor()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Memory budget for upload parts"""
+from threading import Condition
+import asyncio, logging
+
+logger = logging.getLogger("Buffers")
+
+
+class BufferPool:
+    """Process-wide byte budget for part data held in memory
+
+    The upload engine reserves every part attempt's memory footprint before sending it,
+    blocking while the budget is used up; so memory stays bounded whatever the number of
+    workers, files or the part size handed out by the server. A reservation larger than
+    the whole budget still passes once nothing else is reserved.
+    """
+
+    BUDGET = 64 * 2**20
+
+    def __init__(self, budget: int = None) -> None:
+        """
+        Args:
+            budget (int, optional): 内存预算 (B). Defaults to `BUDGET`.
+        """
+        self.budget = budget or self.BUDGET
+        self.reserved = 0
+        self.cond = Condition()
+        self._waiters = []
+
+    def try_reserve(self, size: int) -> bool:
+        """reserves `size` bytes if they fit in the budget right away,without blocking"""
+        with self.cond:
+            if self.reserved and self.reserved + size > self.budget:
+                return False
+            self.reserved += size
+            return True
+
+    def reserve(self, size: int):
+        """blocks until `size` bytes fit in the budget,then reserves them"""
+        with self.cond:
+            self.cond.wait_for(lambda: not self.reserved or self.reserved + size <= self.budget)
+            self.reserved += size
+
+    async def reserve_async(self, size: int):
+        """`reserve` for coroutines"""
+        loop = asyncio.get_running_loop()
+        while not self.try_reserve(size):
+            future = loop.create_future()
+            with self.cond:
+                self._waiters.append((loop, future))
+            if self.try_reserve(size):  # released meanwhile
+                return
+            await future
+
+    def release(self, size: int):
+        with self.cond:
+            self.reserved -= size
+            waiters, self._waiters = self._waiters, []
+            self.cond.notify_all()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+
+
+buffer_pool = BufferPool()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Upload CDN probing results,cached per network"""
+from threading import Lock
+from typing import Callable, List, NamedTuple
+import socket, time, logging
+
+logger = logging.getLogger("CDN")
+
+
+class CDNProbe(NamedTuple):
+    """Measurement of one upload CDN"""
+
+    cdn: str
+    rtt: float
+    """Seconds taken by an empty request"""
+    goodput: float
+    """B/s of the probing burst"""
+
+
+def network_key(host: str = "member.bilibili.com", proxies: str = "") -> str:
+    """identifies the network we're on by the local address routing to `host` (and any proxies)"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect((host, 80))  # no packets are sent for UDP
+            local = s.getsockname()[0]
+    except OSError:
+        local = "?"
+    return "%s|%s" % (local, proxies)
+
+
+class CDNRankings:
+    """Process-wide cache of CDN rankings (fastest first) per network"""
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.entries = dict()
+
+    def rank(self, network: str, probe: Callable[[], List[CDNProbe]], ttl: float) -> List[CDNProbe]:
+        """cached ranking of `network`,calling `probe` if it's missing or older than `ttl` seconds
+
+        Concurrent callers wait for the same probe instead of running their own.
+        """
+        with self.lock:
+            entry = self.entries.get(network)
+            if entry and time.monotonic() - entry[0] < ttl:
+                return entry[1]
+            ranking = sorted(probe(), key=lambda p: (-p.goodput, p.rtt))
+            for p in ranking:
+                logger.debug("%6s : %.0f ms, %.2f MB/s" % (p.cdn, p.rtt * 1e3, p.goodput / 1e6))
+            if ranking:
+                self.entries[network] = (time.monotonic(), ranking)
+            return ranking
+
+    def invalidate(self, network: str = None):
+        """drops the ranking of `network`,or of every network"""
+        with self.lock:
+            if network is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(network, None)
+
+
+cdn_rankings = CDNRankings()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Index of uploaded files by content, to skip uploading identical ones again"""
+from threading import Lock
+import hashlib, json, os, sqlite3, time, logging
+
+from bilibili_toolman.bilisession.common import FileManager
+
+logger = logging.getLogger("Dedupe")
+
+
+def fingerprint(path, full: bool = False) -> str:
+    """fast content fingerprint of `path` (a local path or an `UploadSource`) : its size and
+    a hash of `UploadIndex.SAMPLES` blocks spread evenly across it, plus a hash of the whole
+    file with `full` set
+
+    Sampled fingerprints tell apart files of different sizes or with any sampled block
+    differing, which is good enough for re-runs of the same downloads; `full` rules out
+    files that only differ between samples, at the cost of reading them once.
+    """
+    manager = FileManager()
+    manager.open(path)
+    try:
+        size = manager[path]["length"]
+        block = UploadIndex.SAMPLE_SIZE
+        sampled = hashlib.sha1(str(size).encode())
+        if size <= block * UploadIndex.SAMPLES:
+            offsets, block = [0], size
+        else:
+            step = (size - block) // (UploadIndex.SAMPLES - 1)
+            offsets = [step * i for i in range(UploadIndex.SAMPLES)]
+        for offset in offsets:
+            sampled.update(manager.read(path, offset, offset + block))
+        digest = "%d:%s" % (size, sampled.hexdigest())
+        if full:
+            whole = hashlib.sha1()
+            for start in range(0, size, FileManager.CHUNK_SIZE * 16):
+                whole.update(manager.read(path, start, min(size, start + FileManager.CHUNK_SIZE * 16)))
+            digest += ":" + whole.hexdigest()
+        return digest
+    finally:
+        manager.close(path)
+
+
+class UploadIndex:
+    """SQLite index mapping file fingerprints to the results of their uploads
+
+    Results are only reused within `ttl` seconds of the upload, as uploaded files that were
+    never submitted don't stay valid server-side forever. Keys are namespaced by account &
+    upload profile, since an upload can only be used by the account that made it.
+    """
+
+    SAMPLES = 16
+    SAMPLE_SIZE = 2**16
+
+    def __init__(self, path: str, ttl: float = 24 * 3600) -> None:
+        """
+        Args:
+            path (str): 索引文件路径
+            ttl (float, optional): 上传结果有效期（秒）. Defaults to 24 小时.
+        """
+        self.path, self.ttl = os.path.abspath(os.path.expanduser(path)), ttl
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS uploaded (key TEXT PRIMARY KEY, result TEXT, created REAL)"
+        )
+
+    @staticmethod
+    def key(fingerprint: str, namespace: str = "") -> str:
+        return "%s|%s" % (namespace, fingerprint)
+
+    def lookup(self, key: str):
+        """the recorded result under `key`,None if there's none or it expired"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT result, created FROM uploaded WHERE key = ?", (key,)
+            ).fetchone()
+            if not row:
+                return None
+            result, created = row
+            if time.time() - created > self.ttl:
+                logger.debug("索引已过期: %s" % key)
+                self.db.execute("DELETE FROM uploaded WHERE key = ?", (key,))
+                return None
+        return json.loads(result)
+
+    def record(self, key: str, result):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO uploaded VALUES (?, ?, ?)",
+                (key, json.dumps(result), time.time()),
+            )
+
+    def forget(self, key: str):
+        with self.lock:
+            self.db.execute("DELETE FROM uploaded WHERE key = ?", (key,))
+
+    def purge(self) -> int:
+        """drops expired entries,returns how many there were"""
+        with self.lock:
+            return self.db.execute(
+                "DELETE FROM uploaded WHERE created < ?", (time.time() - self.ttl,)
+            ).rowcount
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Whole-file digests computed from the parts as they're uploaded"""
+from threading import Event, Lock, Thread
+import hashlib, queue, logging
+
+from bilibili_toolman.bilisession.common import FileIterator
+from bilibili_toolman.bilisession.common.buffers import buffer_pool
+
+logger = logging.getLogger("Digest")
+
+
+class OrderedDigest:
+    """Hashes a file front to back from the parts read for its upload,so the whole-file
+    digest needs no extra pass over the file afterwards
+
+    Parts are handed over with `feed` as they're read, in whatever order they go out. A thread
+    hashes the part at the hashed frontier right away (`hashlib` releases the GIL on large
+    updates, so this overlaps with the part's own transfer); parts ahead of the frontier are
+    copied and held until it reaches them. Parts that didn't fit, and ranges never fed at
+    all (e.g. uploaded by other processes), are read from the file once the frontier reaches
+    them, or by `hexdigest` at the latest.
+
+    Held copies are capped by their own share of `buffer_pool`'s budget, shared by all
+    digests, rather than reserved from it : they're only freed once the frontier moves on,
+    so taking from the budget could leave the part at the frontier unable to be sent.
+    """
+
+    HOLD_SHARE = 0.25
+    """Share of `buffer_pool.budget` all digests together may hold parts ahead of their frontier in"""
+
+    _held_bytes = 0
+    _held_lock = Lock()
+
+    def __init__(self, path, size: int, manager, algorithm: str = "md5") -> None:
+        """
+        Args:
+            path (str): 文件路径或 `UploadSource`
+            size (int): 文件大小
+            manager (FileManager): 读取未经 `feed` 部分时所用的 `FileManager`
+            algorithm (str, optional): `hashlib` 算法名. Defaults to "md5".
+        """
+        self.path, self.size, self.manager = path, size, manager
+        self.hash = hashlib.new(algorithm)
+        self.frontier = 0
+        self.held = dict()  # start : copy of the part
+        self.dropped = dict()  # start : end,of parts to be read again
+        self.reread = 0
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def feed(self, start: int, data) -> Event:
+        """hands over the part at `start`. The returned `Event` is set once `data` is no longer
+        needed,and its buffer may be reused"""
+        done = Event()
+        if self.thread is None:
+            self.thread = Thread(target=self._worker, name="OrderedDigest", daemon=True)
+            self.thread.start()
+        self.queue.put((start, data, done))
+        return done
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            start, data, done = item
+            try:
+                self._take(start, data)
+            except Exception as e:
+                logger.warning("无法计算分块摘要：%s" % e)
+            finally:
+                done.set()
+            self._advance()
+
+    def _take(self, start: int, data):
+        end = start + len(data)
+        if start == self.frontier:
+            self.hash.update(data)
+            self.frontier = end
+        elif start > self.frontier and start not in self.held and start not in self.dropped:
+            if self._hold(len(data)):
+                self.held[start] = bytes(data)
+            else:
+                self.dropped[start] = end
+        # otherwise a retried part that's been hashed already
+
+    @classmethod
+    def _hold(cls, size: int) -> bool:
+        with cls._held_lock:
+            if cls._held_bytes + size > buffer_pool.budget * cls.HOLD_SHARE:
+                return False
+            cls._held_bytes += size
+            return True
+
+    @classmethod
+    def _unhold(cls, size: int):
+        with cls._held_lock:
+            cls._held_bytes -= size
+
+    def _advance(self, final: bool = False):
+        """hashes whatever's contiguous with the frontier. With `final`,up to the end of file"""
+        while self.frontier < self.size:
+            if self.frontier in self.held:
+                data = self.held.pop(self.frontier)
+                self.hash.update(data)
+                self.frontier += len(data)
+                self._unhold(len(data))
+                continue
+            if self.frontier in self.dropped:
+                end = self.dropped.pop(self.frontier)
+            elif final:
+                ahead = [start for start in (*self.held, *self.dropped) if start > self.frontier]
+                end = min(ahead + [self.size])
+            else:
+                return
+            self.reread += end - self.frontier
+            for data in FileIterator(self.path, self.frontier, end, self.manager):
+                self.hash.update(data)
+            self.frontier = end
+
+    def _stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        """stops the hashing thread,and frees the parts still held"""
+        self._stop()
+        for data in self.held.values():
+            self._unhold(len(data))
+        self.held.clear()
+
+    def hexdigest(self) -> str:
+        """the digest of the whole file,reading what hasn't been fed yet"""
+        self._stop()
+        self._advance(final=True)
+        if self.reread:
+            logger.debug("计算摘要时重新读取了 %s B" % self.reread)
+        return self.hash.hexdigest()
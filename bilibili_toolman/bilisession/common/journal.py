@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Persistent part journal for resuming interrupted uploads"""
+from threading import Lock
+import json, os, sqlite3, time, logging
+
+from bilibili_toolman.bilisession.common import file_key
+
+logger = logging.getLogger("Journal")
+
+
+class UploadJournal:
+    """SQLite journal of upload sessions and their completed parts
+
+    Uploads are keyed by file path + size + mtime, so a modified file is never resumed.
+    Entries older than `ttl` seconds are assumed expired server-side and ignored.
+    """
+
+    def __init__(self, path: str, ttl: float = 12 * 3600) -> None:
+        """
+        Args:
+            path (str): 记录文件路径
+            ttl (float, optional): 上传会话有效期（秒）. Defaults to 12 小时.
+        """
+        self.path, self.ttl = os.path.abspath(os.path.expanduser(path)), ttl
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS uploads (key TEXT PRIMARY KEY, state TEXT, created REAL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS parts (key TEXT, part INTEGER, PRIMARY KEY (key, part))"
+        )
+
+    @staticmethod
+    def key(path: str, namespace: str = "") -> str:
+        """journal key of `path` in its current state"""
+        return "%s|%s" % (namespace, file_key(path))
+
+    def lookup(self, key: str):
+        """returns (state, completed part numbers) of an unexpired upload,or (None, set())"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT state, created FROM uploads WHERE key = ?", (key,)
+            ).fetchone()
+            if not row:
+                return None, set()
+            state, created = row
+            if time.time() - created > self.ttl:
+                logger.debug("记录已过期: %s" % key)
+                self._forget(key)
+                return None, set()
+            parts = self.db.execute("SELECT part FROM parts WHERE key = ?", (key,)).fetchall()
+        return json.loads(state), {part for part, in parts}
+
+    def begin(self, key: str, state: dict):
+        """records a new upload session,discarding any previous one under `key`"""
+        with self.lock:
+            self._forget(key)
+            self.db.execute(
+                "INSERT INTO uploads VALUES (?, ?, ?)", (key, json.dumps(state), time.time())
+            )
+
+    def complete_part(self, key: str, part: int):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO parts VALUES (?, ?)", (key, part))
+
+    def _forget(self, key: str):
+        self.db.execute("DELETE FROM uploads WHERE key = ?", (key,))
+        self.db.execute("DELETE FROM parts WHERE key = ?", (key,))
+
+    def finish(self, key: str):
+        """forgets the upload once it's complete (or can't be resumed)"""
+        with self.lock:
+            self._forget(key)
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Upload progress events & their aggregation"""
+from collections import deque
+from typing import Callable, NamedTuple
+import logging, time
+
+logger = logging.getLogger("Progress")
+
+
+class ProgressEvent(NamedTuple):
+    kind: str
+    job: object
+    """`UploadJob` the event belongs to"""
+    chunk: object = None
+    """Upload part,for part events"""
+    nbytes: int = 0
+    """Bytes sent,for `PART_SENT` events"""
+    time: float = 0
+
+
+class ProgressBus:
+    """Delivers upload progress events to subscriber callbacks
+
+    Events are published on the uploading event loop's thread, subscribers are called
+    synchronously with a `ProgressEvent` and should return quickly.
+
+    Kinds:
+        job_start   : a job (or a re-upload round of its failed parts) is scheduled
+        job_done    : a job has nothing left to upload. `job.parts_failed` tells if it succeeded
+        part_start  : an attempt of a part is sent,hedged duplicates included
+        part_sent   : `nbytes` more bytes of a part are sent
+        part_done   : a part is uploaded
+        part_retry  : a failed part will be retried
+        part_failed : a part ran out of retries
+    """
+
+    JOB_START = "job_start"
+    JOB_DONE = "job_done"
+    PART_START = "part_start"
+    PART_SENT = "part_sent"
+    PART_DONE = "part_done"
+    PART_RETRY = "part_retry"
+    PART_FAILED = "part_failed"
+
+    def __init__(self) -> None:
+        self.subscribers = []
+
+    def subscribe(self, callback: Callable[[ProgressEvent], None]):
+        """adds `callback`,returns it so it can be used as a decorator"""
+        self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def publish(self, kind: str, job, chunk=None, nbytes: int = 0):
+        if not self.subscribers:
+            return
+        event = ProgressEvent(kind, job, chunk, nbytes, time.monotonic())
+        for callback in list(self.subscribers):
+            try:
+                callback(event)
+            except Exception as e:
+                logger.warning("进度回调出错：%s" % e)
+
+
+class RateMeter:
+    """Throughput over a sliding window of `WINDOW` seconds"""
+
+    WINDOW = 5
+
+    def __init__(self) -> None:
+        self.samples = deque()
+        self.total = 0
+
+    def add(self, nbytes: int, now: float):
+        self.samples.append((now, nbytes))
+        self.total += nbytes
+        self._expire(now)
+
+    def _expire(self, now: float):
+        while self.samples and now - self.samples[0][0] > self.WINDOW:
+            self.total -= self.samples.popleft()[1]
+
+    @property
+    def rate(self) -> float:
+        """B/s"""
+        now = time.monotonic()
+        self._expire(now)
+        if not self.samples:
+            return 0.0
+        return self.total / max(now - self.samples[0][0], 1)
+
+
+class ProgressTracker:
+    """`ProgressBus` subscriber aggregating events into per-job & global progress and rates
+
+    e.g. `progress_bus.subscribe(ProgressTracker())`
+    """
+
+    def __init__(self) -> None:
+        self.jobs = dict()
+        self.meter = RateMeter()
+
+    def __call__(self, event: ProgressEvent):
+        job = event.job
+        if event.kind == ProgressBus.JOB_START:
+            # parts resumed from a journal,or finished in earlier rounds,are already done
+            self.jobs[job] = {
+                "done": job.size - job.pending_bytes,
+                "sending": dict(),
+                "meter": RateMeter(),
+            }
+            return
+        stats = self.jobs.get(job)
+        if stats is None:
+            return
+        if event.kind == ProgressBus.JOB_DONE:
+            del self.jobs[job]
+        elif event.kind == ProgressBus.PART_START:
+            stats["sending"][id(event.chunk)] = 0
+        elif event.kind == ProgressBus.PART_SENT:
+            sending = stats["sending"]
+            sending[id(event.chunk)] = sending.get(id(event.chunk), 0) + event.nbytes
+            self._measure(stats, event.nbytes, event.time)
+        elif event.kind in {ProgressBus.PART_DONE, ProgressBus.PART_RETRY, ProgressBus.PART_FAILED}:
+            sent = stats["sending"].pop(id(event.chunk), 0)
+            if event.kind == ProgressBus.PART_DONE:
+                stats["done"] += len(event.chunk)
+                # parts that don't report `part_sent` are counted once they're done
+                self._measure(stats, max(len(event.chunk) - sent, 0), event.time)
+
+    def _measure(self, stats, nbytes, now):
+        stats["meter"].add(nbytes, now)
+        self.meter.add(nbytes, now)
+
+    def progress(self, job) -> int:
+        """bytes of `job` uploaded so far,parts in flight included"""
+        stats = self.jobs.get(job)
+        if stats is None:
+            return 0
+        return min(stats["done"] + sum(stats["sending"].values()), job.size)
+
+    def job_rate(self, job) -> float:
+        """B/s of `job`"""
+        stats = self.jobs.get(job)
+        return stats["meter"].rate if stats else 0.0
+
+    @property
+    def rate(self) -> float:
+        """B/s of all jobs"""
+        return self.meter.rate
+
+
+progress_bus = ProgressBus()
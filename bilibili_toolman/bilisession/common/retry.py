@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Retries with exponential backoff, retry budgets & per-endpoint circuit breakers"""
+from threading import Lock
+import asyncio, logging, random, time
+
+logger = logging.getLogger("Retry")
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to an endpoint that keeps failing"""
+
+    def __init__(self, key, retry_after) -> None:
+        self.key, self.retry_after = key, retry_after
+        super().__init__("%s 暂不可用，%.1f 秒后重试" % (key, retry_after))
+
+
+class CircuitBreaker:
+    """closed -> (`threshold` consecutive failures) -> open -> (`cooldown` seconds) -> half-open
+
+    While half-open one probe request is let through; its success closes the breaker,
+    its failure opens it again.
+    """
+
+    def __init__(self, key, threshold: int = 5, cooldown: float = 30) -> None:
+        self.key, self.threshold, self.cooldown = key, threshold, cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = Lock()
+
+    @property
+    def retry_after(self) -> float:
+        """seconds until the breaker lets requests through again"""
+        if self.opened_at is None:
+            return 0
+        return max(self.opened_at + self.cooldown - time.monotonic(), 0)
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.retry_after > 0 or self.probing:
+                return False
+            self.probing = True  # half-open
+            return True
+
+    def check(self):
+        """raises `CircuitOpenError` if requests shouldn't be sent"""
+        if not self.allow():
+            raise CircuitOpenError(self.key, self.retry_after or self.cooldown)
+
+    def record_success(self):
+        with self.lock:
+            self.failures, self.opened_at, self.probing = 0, None, False
+
+    def release(self):
+        """ends a half-open probe that finished without an outcome (e.g. was cancelled),
+        so the next request may probe instead"""
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if self.opened_at is None or self.probing:
+                    logger.warning("%s 连续失败 %s 次，暂停请求 %s 秒" % (self.key, self.failures, self.cooldown))
+                self.opened_at, self.probing = time.monotonic(), False
+
+
+class CircuitBreakers(dict):
+    """process-wide registry of `CircuitBreaker`s,keyed by endpoint"""
+
+    THRESHOLD = 5
+    COOLDOWN = 30
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.lock = Lock()
+
+    def __missing__(self, key):
+        with self.lock:
+            return self.setdefault(key, CircuitBreaker(key, self.THRESHOLD, self.COOLDOWN))
+
+
+class RetryBudget:
+    """caps the total retries spent by one job,shared by all its requests"""
+
+    def __init__(self, limit: int) -> None:
+        self.limit, self.spent = limit, 0
+
+    def spend(self) -> bool:
+        if self.spent >= self.limit:
+            return False
+        self.spent += 1
+        return True
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter
+
+    Attempt `n` (from 0) failing waits between half of and all of `min(max_delay, delay * 2 ** n)` seconds.
+    """
+
+    def __init__(self, retries: int = 5, delay: float = 1, max_delay: float = 60) -> None:
+        self.retries, self.delay, self.max_delay = max(int(retries), 1), delay, max_delay
+
+    def backoff(self, attempt: int) -> float:
+        ceiling = min(self.max_delay, self.delay * 2 ** attempt)
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def _attempts(self, key, budget: RetryBudget):
+        breaker = breakers[key] if key else None
+        for attempt in range(self.retries):
+            if attempt and budget and not budget.spend():
+                logger.warning("重试次数已用尽")
+                return
+            if breaker:
+                breaker.check()
+            yield attempt, breaker
+
+    def run(self, func, *args, key=None, budget: RetryBudget = None, retry_on=Exception, **kwargs):
+        """calls `func` until it returns without raising
+
+        Args:
+            key : endpoint of the circuit breaker to go through,if any
+            budget : retry budget to spend retries from,if any
+            retry_on : exception type(s) worth retrying,others are raised right away
+
+        Raises:
+            The last exception raised by `func`, or `CircuitOpenError`
+        """
+        error = None
+        for attempt, breaker in self._attempts(key, budget):
+            try:
+                result = func(*args, **kwargs)
+                if breaker:
+                    breaker.record_success()
+                return result
+            except Exception as e:
+                if breaker:
+                    breaker.record_failure()
+                if not isinstance(e, retry_on):
+                    raise
+                logger.warning("第 %s 次尝试失败：%s" % (attempt + 1, e))
+                error = e
+                if attempt + 1 < self.retries:
+                    time.sleep(self.backoff(attempt))
+            except BaseException:
+                if breaker:
+                    breaker.release()
+                raise
+        raise error
+
+    async def run_async(
+        self, func, *args, key=None, budget: RetryBudget = None, retry_on=Exception, **kwargs
+    ):
+        """`run` for coroutine functions"""
+        error = None
+        for attempt, breaker in self._attempts(key, budget):
+            try:
+                result = await func(*args, **kwargs)
+                if breaker:
+                    breaker.record_success()
+                return result
+            except Exception as e:
+                if breaker:
+                    breaker.record_failure()
+                if not isinstance(e, retry_on):
+                    raise
+                logger.warning("第 %s 次尝试失败：%s" % (attempt + 1, e))
+                error = e
+                if attempt + 1 < self.retries:
+                    await asyncio.sleep(self.backoff(attempt))
+            except BaseException:  # cancelled mid-probe
+                if breaker:
+                    breaker.release()
+                raise
+        raise error
+
+
+breakers = CircuitBreakers()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Process-wide uploader service"""
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import RLock, Thread, current_thread
+import asyncio, atexit, logging
+
+logger = logging.getLogger("UploadService")
+
+
+class UploadService:
+    """One long-lived event loop & bounded worker pool running every upload of the process
+
+    Uploads submitted from any thread share the loop's upload engines (and with them their
+    keep-alive connections & tuned concurrency), while blocking calls run on at most
+    `workers` reusable threads. The service starts on first use; `drain` waits for all
+    uploads to finish and `shutdown` releases the loop, engines and threads.
+    """
+
+    WORKERS = 16
+
+    def __init__(self, workers: int = None) -> None:
+        """
+        Args:
+            workers (int, optional): 阻塞操作（API 请求、读取文件等）线程数. Defaults to `WORKERS`.
+        """
+        self.workers = workers or self.WORKERS
+        self.lock = RLock()
+        self.loop: asyncio.AbstractEventLoop = None
+        self.thread: Thread = None
+        self.executor: ThreadPoolExecutor = None
+        self.accepting = False
+        self._futures = set()
+        self._closers = []
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """starts the service if it isn't running,and (re)opens it for new uploads"""
+        with self.lock:
+            if not self.running:
+                self.executor = ThreadPoolExecutor(self.workers, "UploadWorker")
+                self.loop = asyncio.new_event_loop()
+                self.loop.set_default_executor(self.executor)
+                self.thread = Thread(target=self._run, name="UploadService", daemon=True)
+                self.thread.start()
+                logger.debug("上传服务已启动 (%s 线程)" % self.workers)
+            self.accepting = True
+        return self
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def at_shutdown(self, closer):
+        """registers coroutine function `closer` to be awaited on the loop at shutdown"""
+        self._closers.append(closer)
+
+    def submit(self, coro) -> Future:
+        """schedules `coro` on the service loop
+
+        Raises:
+            RuntimeError: 服务正在停止时引发
+        """
+        with self.lock:
+            if not self.running:
+                self.start()
+            elif not self.accepting:
+                coro.close()
+                raise RuntimeError("上传服务正在停止，不再接受新任务")
+            future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+            self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        return future
+
+    def run(self, coro):
+        """runs `coro` on the service loop and blocks until it's done"""
+        if current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError("不可在上传服务线程内阻塞等待")
+        return self.submit(coro).result()
+
+    def drain(self, timeout: float = None) -> bool:
+        """stops accepting uploads and waits for the ones in progress,until `start` is called again
+
+        Returns:
+            bool: 是否所有任务均已完成
+        """
+        self.accepting = False
+        done, pending = wait(list(self._futures), timeout)
+        return not pending
+
+    def shutdown(self, drain: bool = True, timeout: float = None):
+        """stops the service,cancelling uploads still running after draining
+
+        Args:
+            drain (bool, optional): 是否等待进行中的任务. Defaults to True.
+            timeout (float, optional): 等待时限. Defaults to None.
+        """
+        if not self.running:
+            return
+        self.accepting = False
+        if drain:
+            self.drain(timeout)
+
+        async def stop():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for closer in self._closers:
+                try:
+                    await closer()
+                except Exception as e:
+                    logger.warning("关闭时出错：%s" % e)
+            self._closers.clear()
+
+        with self.lock:
+            if not self.running:
+                return
+            asyncio.run_coroutine_threadsafe(stop(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.executor.shutdown(wait=True)
+            self.loop = self.thread = self.executor = None
+            logger.debug("上传服务已停止")
+
+
+upload_service = UploadService()
+atexit.register(upload_service.shutdown, False)
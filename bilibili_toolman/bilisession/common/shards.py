@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Uploading the parts of one job from several processes"""
+from typing import List
+import asyncio, multiprocessing, queue, logging
+
+from bilibili_toolman.bilisession.common import FileManager
+from bilibili_toolman.bilisession.common.bandwidth import governor
+from bilibili_toolman.bilisession.common.buffers import buffer_pool
+from bilibili_toolman.bilisession.common.progress import ProgressBus, progress_bus
+from bilibili_toolman.bilisession.common.upload import UploadAborted, UploadJob
+
+logger = logging.getLogger("Shards")
+
+PART_DONE = "done"
+SHARD_DONE = "exit"
+SHARD_ABORTED = "aborted"
+SHARD_FAILED = "error"
+
+
+def _run_shard(state: dict, shard: List[tuple], index: int, events):
+    """entry point of a shard process : uploads `shard` through a session rebuilt from `state`"""
+    from bilibili_toolman.bilisession.web import BiliSession
+    from bilibili_toolman.bilisession.common.service import upload_service
+
+    session = BiliSession.from_bytes(state["session"])
+    for name, value in state["settings"].items():
+        setattr(session, name, value)
+    FileManager.MODE, FileManager.PREFETCH = state["file_mode"], state["prefetch"]
+    governor.set_limits(*state["limits"])
+    buffer_pool.budget = state["memory_budget"]
+
+    job = UploadJob(state["path"], state["weight"], state["priority"])
+    job.headers.update(state["headers"])
+    job.failover = state["failover"]
+    job.on_part_done.append(lambda chunk: events.put((index, PART_DONE, chunk.shard_part)))
+    for cls, part, attrs in shard:
+        chunk = cls.__new__(cls)
+        chunk.__dict__.update(attrs)
+        chunk.session, chunk.headers, chunk.shard_part = session, job.headers, part
+        job.add_chunk(chunk)
+    job.open()
+    try:
+        session._run_blocking(session._upload_chunks_to_endpoint(job))
+        events.put((index, SHARD_DONE, None))
+    except UploadAborted as e:
+        events.put((index, SHARD_ABORTED, str(e)))
+    except BaseException as e:
+        events.put((index, SHARD_FAILED, str(e)))
+    finally:
+        job.close()
+        upload_service.shutdown(drain=False)
+
+
+class ShardedUpload:
+    """Uploads the parts of a job from several child processes, each with its own session,
+    event loop, connections and file descriptor, so throughput scales with cores rather than
+    being capped by one interpreter. The parent only relays completed parts back to the job
+    (its `on_part_done` callbacks & `progress_bus`), and finishing the upload stays up to it.
+
+    Parts are dealt round-robin, so the shards together still read the file front to back.
+    Children are spawned rather than forked, as the parent's upload service runs threads.
+    Bandwidth limits in force when the upload starts, and the memory budget, are split evenly
+    between the children.
+    """
+
+    POLL_INTERVAL = 1
+    """Seconds between checks for children that died without reporting"""
+
+    def __init__(self, session, processes: int) -> None:
+        """
+        Args:
+            session (BiliSession): 上传所用会话，其凭据与设置将复制至各进程
+            processes (int): 进程数
+        """
+        self.session = session
+        self.processes = processes
+        self.context = multiprocessing.get_context("spawn")
+
+    def _state(self, job: UploadJob, processes: int) -> dict:
+        session = self.session
+        settings = {name: getattr(session, name) for name in dir(type(session)) if name.isupper()}
+        settings.update(UPLOAD_PROCESSES=1, UPLOAD_JOURNAL=None, UPLOAD_INDEX=None)  # kept by the parent
+        settings.update(proxies=session.proxies, trust_env=session.trust_env)
+        return {
+            "session": session.to_bytes(),
+            "settings": settings,
+            "path": job.path,
+            "weight": job.weight,
+            "priority": job.priority,
+            "headers": job.headers,
+            "failover": job.failover,
+            "file_mode": FileManager.MODE,
+            "prefetch": FileManager.PREFETCH,
+            "limits": tuple(
+                rate / processes if rate else None
+                for rate in (governor.rate(governor.UP), governor.rate(governor.DOWN))
+            ),
+            "memory_budget": max(buffer_pool.budget // processes, 1),
+        }
+
+    @staticmethod
+    def _describe(chunk) -> dict:
+        return {
+            k: v for k, v in chunk.__dict__.items() if k not in {"session", "job", "file_manager", "headers", "digest"}
+        }
+
+    async def run(self, job: UploadJob) -> bool:
+        """uploads every pending part of `job`
+
+        Raises:
+            UploadAborted: 任一进程的任务被放弃时引发
+            Exception: 任一进程仍有分块上传失败时引发
+        """
+        progress_bus.publish(ProgressBus.JOB_START, job)  # while parts are still pending
+        chunks = list(job.chunks)
+        job.chunks.clear()
+        job.pending_bytes = 0
+        processes = max(min(self.processes, len(chunks)), 1)
+        shards = [
+            [(type(chunk), part, self._describe(chunk)) for part, chunk in enumerate(chunks)][i::processes]
+            for i in range(processes)
+        ]
+        state = self._state(job, processes)
+        events = self.context.Queue()
+        children = [
+            self.context.Process(
+                target=_run_shard, args=(state, shard, index, events), name="UploadShard_%d" % index
+            )
+            for index, shard in enumerate(shards)
+        ]
+        for child in children:
+            child.daemon = True
+            child.start()
+        logger.debug("分块分散至 %s 个进程上传" % len(children))
+        loop = asyncio.get_running_loop()
+        running, aborted, errors = set(range(len(children))), None, []
+        try:
+            while running:
+                try:
+                    index, kind, value = await loop.run_in_executor(
+                        None, events.get, True, self.POLL_INTERVAL
+                    )
+                except queue.Empty:
+                    for index in list(running):
+                        if not children[index].is_alive():  # died without a word
+                            running.discard(index)
+                            errors.append("进程 %s 意外退出 (exitcode %s)" % (index, children[index].exitcode))
+                    continue
+                if kind == PART_DONE:
+                    chunk = chunks[value]
+                    job.parts_done += 1
+                    for callback in job.on_part_done:
+                        callback(chunk)
+                    progress_bus.publish(ProgressBus.PART_DONE, job, chunk)
+                    continue
+                running.discard(index)
+                if kind == SHARD_ABORTED:
+                    aborted = value
+                    break  # the whole job restarts elsewhere
+                if kind == SHARD_FAILED:
+                    errors.append(value)
+        finally:
+            for child in children:
+                if child.is_alive() and (running or aborted):
+                    child.terminate()
+                child.join()
+            events.close()
+            progress_bus.publish(ProgressBus.JOB_DONE, job)
+        if aborted:
+            job.abort(aborted)
+            raise UploadAborted(aborted)
+        if errors:
+            raise Exception("; ".join(errors))
+        return True
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""Remote, range-readable upload sources"""
+from urllib.parse import quote, unquote, urlsplit
+from requests import Session
+from requests.auth import AuthBase
+import asyncio, datetime, hashlib, hmac, os, re, threading, time, logging
+
+logger = logging.getLogger("Sources")
+
+
+class UploadSource:
+    """A file to upload that isn't on local disk, read by byte ranges
+
+    Uploads accept a local path (a plain `str`) or a source. `FileManager` reads parts of
+    sources with `read`, so parts are fetched by range and forwarded as they're sent,
+    without the whole file ever touching the disk.
+    """
+
+    PIECE_SIZE = 4 * 2**20
+    """Bytes fetched per range request when a part is streamed"""
+
+    PACED = False
+    """Whether reads may wait on whoever produces the source"""
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self._stat = None
+
+    def __eq__(self, other) -> bool:
+        return type(other) is type(self) and other.url == self.url
+
+    def __hash__(self) -> int:
+        return hash((type(self), self.url))
+
+    def __str__(self) -> str:
+        return self.url
+
+    def __repr__(self) -> str:
+        return "<%s %s>" % (type(self).__name__, self.url)
+
+    def __getstate__(self):
+        return {"url": self.url, "_stat": self._stat}
+
+    def __setstate__(self, state):
+        self.__init__(state["url"])
+        self._stat = state["_stat"]
+
+    @property
+    def name(self) -> str:
+        """file name of the source"""
+        return os.path.basename(unquote(urlsplit(self.url).path)) or "video.mp4"
+
+    def stat(self) -> dict:
+        """{"size": B, "version": etag or the like} of the source,fetched once"""
+        if self._stat is None:
+            self._stat = self._fetch_stat()
+        return self._stat
+
+    @property
+    def size(self) -> int:
+        return self.stat()["size"]
+
+    @property
+    def key(self) -> str:
+        """identifies this very content,e.g. to resume its upload"""
+        stat = self.stat()
+        return "%s|%s|%s" % (self.url, stat["size"], stat["version"])
+
+    def _fetch_stat(self) -> dict:
+        raise NotImplementedError
+
+    def read(self, start: int, end: int) -> bytes:
+        """reads [start,end) of the source"""
+        raise NotImplementedError
+
+    def open(self):
+        self.stat()
+
+    def close(self):
+        pass
+
+
+class HTTPSource(UploadSource):
+    """A file served over HTTP(S) by a server honoring `Range` requests"""
+
+    TIMEOUT = (10, 60)
+
+    def __init__(self, url: str, session: Session = None) -> None:
+        """
+        Args:
+            url (str): 文件 URL
+            session (Session, optional): 请求所用会话. Defaults to 新会话.
+        """
+        super().__init__(url)
+        self.session = session or Session()
+
+    def _request(self, method: str, headers: dict):
+        return self.session.request(method, self.url, headers=headers, timeout=self.TIMEOUT)
+
+    def _fetch_stat(self) -> dict:
+        resp = self._request("GET", {"Range": "bytes=0-0"})
+        resp.close()
+        assert resp.status_code == 206, "HTTP %s : 无法按 Range 读取 %s" % (resp.status_code, self.url)
+        size = int(resp.headers["Content-Range"].rsplit("/", 1)[-1])
+        etag, modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+        return {"size": size, "version": etag or modified, "etag": etag, "modified": modified}
+
+    def read(self, start: int, end: int) -> bytes:
+        # imported here,as `bandwidth` needs the package this module is imported by
+        from bilibili_toolman.bilisession.common.bandwidth import governor
+
+        if start >= end:
+            return b""
+        governor.acquire(governor.DOWN, end - start)  # range reads are downloads too
+        headers = {"Range": "bytes=%d-%d" % (start, end - 1)}
+        # fails rather than mixing parts of two versions of the file
+        stat = self.stat()
+        if stat.get("etag") and not stat["etag"].startswith("W/"):
+            headers["If-Match"] = stat["etag"]
+        elif stat.get("modified"):
+            headers["If-Unmodified-Since"] = stat["modified"]
+        resp = self._request("GET", headers)
+        assert resp.status_code == 206, "HTTP %s : 读取 %s-%s 失败 (%s)" % (
+            resp.status_code, start, end, self.url
+        )
+        assert len(resp.content) == end - start, "读取 %s-%s 不完整 (%s B)" % (start, end, len(resp.content))
+        return resp.content
+
+
+class S3Auth(AuthBase):
+    """AWS Signature Version 4 for S3 requests"""
+
+    EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+    def __init__(self, access_key: str, secret_key: str, region: str, token: str = None) -> None:
+        self.access_key, self.secret_key, self.region, self.token = access_key, secret_key, region, token
+
+    @staticmethod
+    def _hmac(key: bytes, msg: str) -> bytes:
+        return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+    def sign(self, method: str, url: str, headers: dict, now: datetime.datetime = None) -> dict:
+        """headers signing a body-less request to `url`, `headers` (e.g. `Range`) included"""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        amz_date, date = now.strftime("%Y%m%dT%H%M%SZ"), now.strftime("%Y%m%d")
+        split = urlsplit(url)
+        signed = {k.lower(): str(v).strip() for k, v in headers.items()}
+        signed.update(
+            {"host": split.netloc, "x-amz-content-sha256": self.EMPTY_SHA256, "x-amz-date": amz_date}
+        )
+        if self.token:
+            signed["x-amz-security-token"] = self.token
+        names = sorted(signed)
+        query = "&".join(
+            sorted(
+                "%s=%s" % (quote(unquote(k), safe="-_.~"), quote(unquote(v), safe="-_.~"))
+                for k, _, v in (p.partition("=") for p in split.query.split("&") if p)
+            )
+        )
+        canonical = "\n".join(
+            [
+                method,
+                quote(unquote(split.path) or "/", safe="/-_.~"),
+                query,
+                "".join("%s:%s\n" % (k, signed[k]) for k in names),
+                ";".join(names),
+                self.EMPTY_SHA256,
+            ]
+        )
+        scope = "%s/%s/s3/aws4_request" % (date, self.region)
+        string_to_sign = "\n".join(
+            ["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()]
+        )
+        key = ("AWS4" + self.secret_key).encode()
+        for part in (date, self.region, "s3", "aws4_request"):
+            key = self._hmac(key, part)
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        signed["Authorization"] = "AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s" % (
+            self.access_key, scope, ";".join(names), signature
+        )
+        signed.pop("host")
+        return signed
+
+    def __call__(self, request):
+        headers = {k: v for k, v in request.headers.items() if k.lower() == "range"}
+        request.headers.update(self.sign(request.method, request.url, headers))
+        return request
+
+
+class S3Source(HTTPSource):
+    """An object in an S3-compatible bucket, e.g. `s3://bucket/path/to/video.mp4`
+
+    Credentials, region & endpoint default to the usual `AWS_ACCESS_KEY_ID`, `AWS_SECRET_ACCESS_KEY`,
+    `AWS_SESSION_TOKEN`, `AWS_REGION` & `AWS_ENDPOINT_URL` environment variables. Objects are
+    addressed path-style (`endpoint/bucket/key`), which S3-compatible stores all understand.
+    Without credentials, requests are sent unsigned (public buckets).
+    """
+
+    def __init__(
+        self,
+        url: str,
+        endpoint: str = None,
+        region: str = None,
+        access_key: str = None,
+        secret_key: str = None,
+        token: str = None,
+        session: Session = None,
+    ) -> None:
+        """
+        Args:
+            url (str): s3://桶/对象键
+            endpoint (str, optional): S3 服务地址. Defaults to $AWS_ENDPOINT_URL 或 AWS.
+            region (str, optional): 区域. Defaults to $AWS_REGION 或 us-east-1.
+            access_key, secret_key, token (str, optional): 凭据. Defaults to 对应环境变量.
+        """
+        super().__init__(url, session)
+        split = urlsplit(url)
+        assert split.scheme == "s3" and split.netloc, "无效的 S3 地址：%s" % url
+        self.region = region or os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION") or "us-east-1"
+        self.endpoint = (
+            endpoint or os.environ.get("AWS_ENDPOINT_URL") or "https://s3.%s.amazonaws.com" % self.region
+        ).rstrip("/")
+        self.object_url = "%s/%s%s" % (self.endpoint, split.netloc, quote(unquote(split.path), safe="/-_.~"))
+        access_key = access_key or os.environ.get("AWS_ACCESS_KEY_ID")
+        secret_key = secret_key or os.environ.get("AWS_SECRET_ACCESS_KEY")
+        self.auth = None
+        if access_key and secret_key:
+            self.auth = S3Auth(access_key, secret_key, self.region, token or os.environ.get("AWS_SESSION_TOKEN"))
+
+    def __getstate__(self):
+        # credentials travel with the source (e.g. to shard processes),not through the environment
+        state = super().__getstate__()
+        auth = self.auth
+        state.update(endpoint=self.endpoint, region=self.region)
+        if auth:
+            state.update(access_key=auth.access_key, secret_key=auth.secret_key, token=auth.token)
+        return state
+
+    def __setstate__(self, state):
+        self.__init__(
+            state["url"],
+            state["endpoint"],
+            state["region"],
+            state.get("access_key"),
+            state.get("secret_key"),
+            state.get("token"),
+        )
+        self._stat = state["_stat"]
+
+    def _request(self, method: str, headers: dict):
+        return self.session.request(
+            method, self.object_url, headers=headers, auth=self.auth, timeout=self.TIMEOUT
+        )
+
+
+class GrowingSource(UploadSource):
+    """A local file still being written (e.g. downloaded) front to back, whose final size is
+    known up front. Parts are readable as soon as their bytes are written, so they can be
+    uploaded while the rest of the file is still coming.
+
+    The writer may write to a `partial` file renamed to `path` once complete, as yt-dlp does
+    with `.part` files; the file stays open across the rename. Reads only wait through
+    `wait_async`; `read` expects its range to be written already.
+    """
+
+    PIECE_SIZE = 2**16
+    PACED = True
+    """Parts wait on the writer, so upload goodput tells nothing about the upload node"""
+    POLL_INTERVAL = 0.5
+    STALL_TIMEOUT = 300
+    """Seconds the file may stop growing before waiting parts fail"""
+
+    def __init__(self, path: str, size: int, partial: str = None) -> None:
+        """
+        Args:
+            path (str): 文件最终路径
+            size (int): 文件最终大小 (B)
+            partial (str, optional): 写入中的临时文件路径. Defaults to path + '.part'.
+        """
+        super().__init__(os.path.abspath(path))
+        self.path = self.url
+        self.partial = os.path.abspath(partial or path + ".part")
+        self._stat = {"size": size, "version": "growing"}
+        self.failed: str = None
+        """Why the writer gave up,if it did"""
+        self._fd = None
+        self._grown = (0, time.monotonic())
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"path": self.path, "size": self.size, "partial": self.partial}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["size"], state["partial"])
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+    def fail(self, reason: str):
+        """tells readers the file won't be completed"""
+        self.failed = reason
+
+    def _open(self):
+        if self._fd is None:
+            for candidate in (self.path, self.partial):
+                try:
+                    self._fd = os.open(candidate, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                    break
+                except FileNotFoundError:
+                    continue
+        return self._fd
+
+    def ready(self, start: int, end: int) -> bool:
+        """whether reading [start,end) won't wait,including when it would fail right away"""
+        return bool(self.failed) or self.written() >= end
+
+    def written(self) -> int:
+        """bytes written so far"""
+        if os.path.isfile(self.path) and os.path.getsize(self.path) == self.size:
+            return self.size  # complete & renamed,maybe by another process
+        fd = self._open()
+        return os.fstat(fd).st_size if fd is not None else 0
+
+    async def wait_async(self, start: int, end: int):
+        """waits until [start,end) is written
+
+        Raises:
+            IOError: 写入方放弃或文件停止增长过久时引发
+        """
+        while True:
+            if self.failed:
+                raise IOError("文件未能写入完成：%s" % self.failed)
+            written, now = self.written(), time.monotonic()
+            if written >= end:
+                return
+            if written != self._grown[0]:
+                self._grown = (written, now)
+            elif now - self._grown[1] > self.STALL_TIMEOUT:
+                self.fail("停止增长")  # for every other reader too
+                raise IOError("文件 %s 已 %s 秒未增长" % (self.name, self.STALL_TIMEOUT))
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    def open(self):
+        pass  # the file may not exist yet
+
+    def read(self, start: int, end: int) -> bytes:
+        fd = self._open()
+        assert fd is not None, "文件 %s 尚未开始写入" % self.name
+        if hasattr(os, "pread"):
+            return os.pread(fd, end - start, start)
+        with self.lock:
+            os.lseek(fd, start, os.SEEK_SET)
+            return os.read(fd, end - start)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def open_source(path):
+    """`path` as an `UploadSource` if it's a URL (http(s)://, s3://),unchanged otherwise"""
+    if isinstance(path, str):
+        scheme = re.match(r"^([a-zA-Z][a-zA-Z0-9+.-]*)://", path)
+        scheme = scheme and scheme.group(1).lower()
+        if scheme in {"http", "https"}:
+            return HTTPSource(path)
+        if scheme == "s3":
+            return S3Source(path)
+    return path
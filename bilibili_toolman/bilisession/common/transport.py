@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""asyncio HTTP/1.1 transport used by the upload engine
+
+`requests` blocks one thread per request; UPOS part PUTs are plain HTTP/1.1 requests
+with a known Content-Length, so they are written straight onto asyncio streams instead.
+This allows hundreds of in-flight parts over one event loop.
+"""
+from requests.adapters import HTTPAdapter
+import asyncio, json, ssl, time, logging
+from typing import AsyncIterable, BinaryIO, Callable, Dict, NamedTuple, Tuple, Union
+from urllib.parse import urlsplit, urlencode
+
+logger = logging.getLogger("Transport")
+
+
+class FileRange(NamedTuple):
+    """A byte range of an open binary file,sent with `loop.sendfile`
+
+    Plain TCP connections send it with `os.sendfile` straight from the file descriptor
+    (no copies through Python); TLS connections fall back to buffered reads & writes.
+    """
+
+    file: BinaryIO
+    offset: int
+    count: int
+
+
+Body = Union[bytes, bytearray, memoryview, AsyncIterable, Callable[[], AsyncIterable], FileRange]
+Timeout = Tuple[float, float]
+"""(connect, read) in seconds,same as `requests`"""
+
+
+class StallError(TimeoutError):
+    """Request body throughput fell below the required minimum"""
+
+
+class StaleConnectionError(ConnectionResetError):
+    """The connection was closed before any byte of the response arrived"""
+
+
+class HTTPResponse:
+    """Fully-read HTTP response"""
+
+    def __init__(self, url: str, status: int, reason: str, headers: dict, content: bytes):
+        self.url, self.status_code, self.reason = url, status, reason
+        self.headers, self.content = headers, content
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 300
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def __repr__(self) -> str:
+        return "<HTTPResponse [%s]>" % self.status_code
+
+
+class AsyncHTTPTransport:
+    """Keep-alive HTTP/1.1 client for one event loop"""
+
+    MAX_IDLE_PER_HOST = 64
+    WRITE_BUFFER_SIZE = 2**16
+
+    def __init__(self, headers: dict = None) -> None:
+        self.headers = {"Connection": "keep-alive", **(headers or {})}
+        self.ssl_context = ssl.create_default_context()
+        self._idle: Dict[Tuple, list] = dict()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    @staticmethod
+    def _key(url: str, local_addr: str = None) -> Tuple:
+        """(scheme, host, port, local_addr) connections to `url` are pooled by"""
+        split = urlsplit(url)
+        port = split.port or (443 if split.scheme == "https" else 80)
+        return split.scheme, split.hostname, port, local_addr
+
+    def _open(self, scheme, host, port, local_addr=None):
+        return asyncio.open_connection(
+            host,
+            port,
+            ssl=self.ssl_context if scheme == "https" else None,
+            local_addr=(local_addr, 0) if local_addr else None,
+        )
+
+    async def _connect(self, scheme, host, port, local_addr=None, fresh=False):
+        """an idle connection to the host if there's one (unless `fresh`),a new one otherwise.
+        Returns (reader, writer, whether it was reused)"""
+        key = (scheme, host, port, local_addr)
+        idle = self._idle.get(key, []) if not fresh else []
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self._open(*key)
+        return reader, writer, False
+
+    async def warm(self, url: str, count: int = 1, local_addr: str = None, timeout: float = None) -> int:
+        """opens connections to `url`'s host ahead of requests,until `count` are idle
+
+        Returns:
+            int: 新建立的连接数
+        """
+        key = self._key(url, local_addr)
+        idle = [c for c in self._idle.get(key, []) if not c[0].at_eof() and not c[1].is_closing()]
+        self._idle[key] = idle
+        missing = min(count, self.MAX_IDLE_PER_HOST) - len(idle)
+        if missing <= 0:
+            return 0
+        results = await asyncio.gather(
+            *(asyncio.wait_for(self._open(*key), timeout) for _ in range(missing)),
+            return_exceptions=True,
+        )
+        opened = [r for r in results if not isinstance(r, BaseException)]
+        for reader, writer in opened:
+            self._release(key, reader, writer, True)
+        return len(opened)
+
+    def _release(self, key, reader, writer, keep_alive):
+        idle = self._idle.setdefault(key, [])
+        if keep_alive and len(idle) < self.MAX_IDLE_PER_HOST:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader, method: str):
+        interim = False
+        while True:
+            try:
+                status_line = await reader.readline()
+            except ConnectionError as e:
+                if interim:
+                    raise
+                raise StaleConnectionError("连接已被远端关闭：%s" % e) from e
+            if not status_line:
+                raise (ConnectionResetError if interim else StaleConnectionError)("连接已被远端关闭")
+            interim = True
+            version, status, *reason = status_line.decode("latin-1").strip().split(" ", 2)
+            headers = dict()
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                k, v = line.decode("latin-1").split(":", 1)
+                headers[k.strip().lower()] = v.strip()
+            if int(status) != 100:  # skips interim `100 Continue` responses
+                break
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        if method == "HEAD" or int(status) in (204, 304):
+            content = b""
+        elif "chunked" in headers.get("transfer-encoding", "").lower():
+            content = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass  # trailers
+                    break
+                content.extend(await reader.readexactly(size))
+                await reader.readexactly(2)
+            content = bytes(content)
+        elif "content-length" in headers:
+            content = await reader.readexactly(int(headers["content-length"]))
+        else:
+            content, keep_alive = await reader.read(), False
+        return int(status), reason[0] if reason else "", headers, content, keep_alive
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        params: dict = None,
+        headers: dict = None,
+        body: Body = b"",
+        length: int = None,
+        timeout: Timeout = None,
+        min_throughput: float = None,
+        local_addr: str = None,
+    ) -> HTTPResponse:
+        """Sends one request and reads its response
+
+        A request that fails on a reused keep-alive connection before any response arrives
+        (the server had closed it meanwhile) is sent once more on a new connection, unless
+        `body` is an async iterable that can't be iterated over again.
+
+        Args:
+            body : bytes-like, `FileRange`, an async iterable of bytes-like objects or a function returning one. In the latter cases `length` must be given
+            length : Content-Length of `body`
+            timeout : (connect, read) timeouts. The read timeout also bounds every wait on the socket while sending
+            min_throughput : B/s. Once `read` seconds have passed, sending `body` any slower raises `StallError`. Time spent waiting on `body` itself isn't counted
+            local_addr : local address to send from,e.g. to pick an uplink
+
+        Raises:
+            asyncio.TimeoutError, StallError
+        """
+        split = urlsplit(url)
+        target = split.path or "/"
+        query = "&".join(filter(None, (split.query, urlencode(params or {}))))
+        if query:
+            target += "?" + query
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            length = len(body)
+        elif isinstance(body, FileRange):
+            length = body.count
+        head = {
+            "Host": split.netloc,
+            **self.headers,
+            **(headers or {}),
+            "Content-Length": str(length or 0),
+        }
+        key = self._key(url, local_addr)
+        replayable = callable(body) or isinstance(body, (bytes, bytearray, memoryview, FileRange))
+        for retry in (False, True):
+            reader, writer, reused = await asyncio.wait_for(
+                self._connect(*key, fresh=retry), (timeout or (None, None))[0]
+            )
+            try:
+                return await self._exchange(
+                    key, reader, writer, method, target, head, body() if callable(body) else body,
+                    timeout, min_throughput, url,
+                )
+            except StaleConnectionError as e:
+                if retry or not reused or not replayable:
+                    raise
+                logger.debug("复用的连接已失效，以新连接重新发送：%s" % e)
+
+    async def _exchange(
+        self, key, reader, writer, method, target, head, body, timeout, min_throughput, url
+    ) -> HTTPResponse:
+        """sends the request on an open connection and reads its response"""
+        read_timeout = (timeout or (None, None))[1]
+        loop = asyncio.get_running_loop()
+        started, sent, waited = loop.time(), 0, 0.0
+        # `waited` : time spent waiting on `body` itself (e.g. bandwidth limits,disk reads),
+        # which tells nothing about the connection and so isn't held against its throughput
+
+        async def drain():
+            try:
+                await asyncio.wait_for(writer.drain(), read_timeout)
+            except asyncio.TimeoutError:
+                raise StallError("发送停滞超过 %s 秒" % read_timeout)
+            elapsed = loop.time() - started - waited
+            if min_throughput and read_timeout and elapsed > read_timeout:
+                if sent / elapsed < min_throughput:
+                    raise StallError("上传速度过低 (%.2f KB/s)" % (sent / elapsed / 1024))
+
+        try:
+            try:
+                writer.write(
+                    (
+                        "%s %s HTTP/1.1\r\n" % (method, target)
+                        + "".join("%s: %s\r\n" % kv for kv in head.items())
+                        + "\r\n"
+                    ).encode("latin-1")
+                )
+                if isinstance(body, (bytes, bytearray, memoryview)):
+                    writer.write(body)
+                    sent = len(body)
+                elif isinstance(body, FileRange):
+                    await drain()
+                    deadline = None
+                    if min_throughput and read_timeout:
+                        deadline = body.count / min_throughput + read_timeout
+                    try:
+                        await asyncio.wait_for(
+                            loop.sendfile(writer.transport, body.file, body.offset, body.count),
+                            deadline,
+                        )
+                    except asyncio.TimeoutError:
+                        raise StallError("%s 秒内未能发送 %s B" % (deadline, body.count))
+                    sent = body.count
+                else:
+                    pieces = body.__aiter__()
+                    while True:
+                        wait_start = loop.time()
+                        try:
+                            piece = await pieces.__anext__()
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            waited += loop.time() - wait_start
+                        writer.write(piece)
+                        sent += len(piece)
+                        if writer.transport.get_write_buffer_size() > self.WRITE_BUFFER_SIZE:
+                            await drain()
+                await drain()
+            except ConnectionError as e:  # nothing of the response was read yet
+                raise StaleConnectionError("发送时连接已断开：%s" % e) from e
+            status, reason, resp_headers, content, keep_alive = await asyncio.wait_for(
+                self._read_response(reader, method), read_timeout
+            )
+        except BaseException:
+            writer.close()
+            raise
+        self._release(key, reader, writer, keep_alive)
+        return HTTPResponse(url, status, reason, resp_headers, content)
+
+    async def close(self):
+        for idle in self._idle.values():
+            for reader, writer in idle:
+                writer.close()
+        self._idle.clear()
+
+
+class StallWatchdog:
+    """Request body for `requests` raising `StallError` once it's sent slower than `min_throughput`
+    B/s,after `grace` seconds. Same rule as `AsyncHTTPTransport.request`'s `min_throughput`,
+    as `requests` itself only bounds every socket operation with its read timeout
+
+    Sized like `body`,so it's still sent with a Content-Length. Time spent waiting on `body`
+    itself isn't counted.
+    """
+
+    def __init__(self, body, min_throughput: float, grace: float) -> None:
+        self.body, self.min_throughput, self.grace = body, min_throughput, grace
+
+    def __len__(self):
+        return len(self.body)
+
+    def __iter__(self):
+        started, sent, waited = time.monotonic(), 0, 0.0
+        pieces = iter(self.body)
+        while True:
+            wait_start = time.monotonic()
+            try:
+                piece = next(pieces)
+            except StopIteration:
+                return
+            finally:
+                waited += time.monotonic() - wait_start
+            elapsed = time.monotonic() - started - waited
+            if self.min_throughput and self.grace and elapsed > self.grace:
+                if sent / elapsed < self.min_throughput:
+                    raise StallError("上传速度过低 (%.2f KB/s)" % (sent / elapsed / 1024))
+            yield piece  # resumed once `requests` has written it out
+            sent += len(piece)
+
+
+class SourceAddressAdapter(HTTPAdapter):
+    """`requests` adapter sending from a given local address"""
+
+    def __init__(self, address: str, **kwargs) -> None:
+        self.source_address = (address, 0)
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["source_address"] = self.source_address
+        return super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **kwargs):
+        kwargs["source_address"] = self.source_address
+        return super().proxy_manager_for(proxy, **kwargs)
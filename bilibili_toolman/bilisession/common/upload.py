@@ -0,0 +1,639 @@
+# -*- coding: utf-8 -*-
+"""asyncio multipart upload engine"""
+from collections import deque
+from functools import partial
+from itertools import count
+from typing import Callable, Dict, Iterable, List
+from urllib.parse import urlsplit
+import asyncio, logging, os, time
+
+from bilibili_toolman.bilisession.common import FileManager, UploadSource
+from bilibili_toolman.bilisession.common.bandwidth import BandwidthGovernor, governor
+from bilibili_toolman.bilisession.common.buffers import buffer_pool
+from bilibili_toolman.bilisession.common.progress import ProgressBus, RateMeter, progress_bus
+from bilibili_toolman.bilisession.common.retry import (
+    CircuitOpenError,
+    RetryBudget,
+    RetryPolicy,
+    breakers,
+)
+from bilibili_toolman.bilisession.common.transport import AsyncHTTPTransport
+
+logger = logging.getLogger("Uploader")
+
+
+class UploadAborted(Exception):
+    """Raised for a job given up on because its endpoint degraded"""
+
+
+class UploadJob:
+    """One file being uploaded
+
+    A job owns its pending parts, file handle, per-upload headers (e.g. `X-Upos-Auth`)
+    and counters, so concurrent uploads within one process never share state.
+    """
+
+    _seq = count()
+
+    def __init__(
+        self, path: str, weight: float = 1, priority: int = BandwidthGovernor.PRIORITY_NORMAL
+    ) -> None:
+        """
+        Args:
+            path (str): 文件路径
+            weight (float, optional): 调度权重，权重越大分得的带宽越多. Defaults to 1.
+            priority (int, optional): 带宽限速时的优先级，越小越优先. Defaults to PRIORITY_NORMAL.
+        """
+        self.path = path
+        self.size = path.size if isinstance(path, UploadSource) else os.stat(path).st_size
+        self.weight = max(float(weight), 1e-3)
+        self.priority = priority
+        self.seq = next(UploadJob._seq)
+        self.file_manager = FileManager()
+        self.headers = dict()
+        """Headers sent along with every part of this job"""
+        self.chunks = deque()
+        self.pending_bytes = 0
+        self.in_flight = 0
+        self.backoff = 0
+        """Failed parts waiting to be requeued"""
+        self.budget: RetryBudget = None
+        self.parts_total = self.parts_done = self.parts_failed = 0
+        self.failed = []
+        """Parts that ran out of retries"""
+        self.vtime = 0.0
+        """Virtual finish time used by weighted-fair queueing"""
+        self.latencies: List[float] = []
+        """Seconds taken by each successful part"""
+        self.on_part_done: List[Callable] = []
+        """Called with every part once it's uploaded"""
+        self.finished: asyncio.Future = None
+        self.failover = False
+        """Abort this job once its endpoint degrades,so it can be restarted elsewhere"""
+        self.aborted: str = None
+        """Why this job was aborted,if it was"""
+        self.error_rate = 0.0
+        """EWMA of part failures"""
+        self.attempts = 0
+        self._window_start, self._window_bytes = time.monotonic(), 0
+
+    def add_chunk(self, chunk):
+        """Adds a part to this job,the part will then read through the job's file handle"""
+        chunk.job = self
+        chunk.file_manager = self.file_manager
+        chunk.attempts = 0
+        self.chunks.append(chunk)
+        self.pending_bytes += len(chunk)
+        self.parts_total += 1
+        return chunk
+
+    def requeue(self, chunk):
+        """puts an unfinished part back at the tail of this job"""
+        if self.aborted:
+            return
+        self.chunks.append(chunk)
+        self.pending_bytes += len(chunk)
+
+    def abort(self, reason: str):
+        """drops every pending part,parts in flight are left to finish"""
+        self.aborted = reason
+        self.chunks.clear()
+        self.pending_bytes = 0
+
+    def redrive(self):
+        """puts every failed part back with its retries reset,returns how many there were"""
+        failed, self.failed = self.failed, []
+        self.parts_failed = 0
+        for chunk in failed:
+            chunk.attempts = 0
+            self.requeue(chunk)
+        return len(failed)
+
+    def readahead(self):
+        """hints the part to be read next to the file manager,so reading it overlaps sending this one"""
+        if self.chunks:
+            chunk = self.chunks[0]
+            self.file_manager.willneed(self.path, chunk.start, chunk.end)
+
+    def extend(self, chunks: Iterable):
+        for chunk in chunks:
+            self.add_chunk(chunk)
+        return self
+
+    def open(self):
+        self.file_manager.open(self.path)
+
+    def close(self):
+        if self.path in self.file_manager:
+            self.file_manager.close(self.path)
+
+    @property
+    def read(self) -> int:
+        """bytes read from disk for this job so far"""
+        # hedged parts are read twice
+        return min(self.file_manager.get(self.path, {}).get("read", 0), self.size)
+
+    def latency_quantile(self, q: float) -> float:
+        """`q`-quantile of part latencies so far"""
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * q), len(latencies) - 1)]
+
+    def __repr__(self) -> str:
+        return "<UploadJob %s (%s/%s parts)>" % (
+            os.path.basename(str(self.path)),
+            self.parts_done,
+            self.parts_total,
+        )
+
+
+class UploadScheduler:
+    """Picks the next part to send across all active jobs
+
+    Policies:
+        wfq : weighted-fair queueing. Every job advances its virtual time by `len(part) / weight`,
+              the job with the smallest virtual time goes next
+        sjf : shortest-job-first. The job with the fewest pending bytes goes next
+    """
+
+    POLICY_WFQ = "wfq"
+    POLICY_SJF = "sjf"
+
+    def __init__(self, policy: str = POLICY_WFQ) -> None:
+        assert policy in {self.POLICY_WFQ, self.POLICY_SJF}, "未知调度策略 %s" % policy
+        self.policy = policy
+        self.jobs: List[UploadJob] = []
+
+    def add(self, job: UploadJob):
+        # new jobs start at the current virtual time so they can't starve others
+        job.vtime = min((j.vtime for j in self.jobs), default=0.0)
+        self.jobs.append(job)
+
+    def remove(self, job: UploadJob):
+        if job in self.jobs:
+            self.jobs.remove(job)
+
+    @property
+    def pending(self) -> bool:
+        """whether any part can be sent right away"""
+        return any(job.chunks and job.chunks[0].ready for job in self.jobs)
+
+    @property
+    def waiting(self) -> List[UploadJob]:
+        """jobs whose next part can't be read yet"""
+        return [job for job in self.jobs if job.chunks and not job.chunks[0].ready]
+
+    def next(self):
+        """pops the next part to be sent,or None if there's nothing left that can be sent"""
+        active = [job for job in self.jobs if job.chunks and job.chunks[0].ready]
+        if not active:
+            return None
+        if self.policy == self.POLICY_SJF:
+            job = min(active, key=lambda j: (j.pending_bytes, j.seq))
+        else:
+            job = min(active, key=lambda j: (j.vtime, j.seq))
+        chunk = job.chunks.popleft()
+        job.pending_bytes -= len(chunk)
+        job.vtime += len(chunk) / job.weight
+        return chunk
+
+
+class ConcurrencyController:
+    """AIMD controller for the number of in-flight parts
+
+    Throughput is sampled once every `limit` completed parts (about one round of in-flight
+    parts). The limit then grows by one if the round's goodput held up, and shrinks by one
+    if it dropped. Failures shrink the limit multiplicatively. The limit always stays
+    within [floor, ceiling].
+    """
+
+    BACKOFF = 0.5
+    """Multiplicative decrease on failure"""
+    TOLERANCE = 0.9
+    """A round whose goodput is above `TOLERANCE` * last round's counts as held up"""
+
+    def __init__(self, initial: int = 3, floor: int = 1, ceiling: int = 32) -> None:
+        self.floor, self.ceiling = max(int(floor), 1), max(int(ceiling), int(floor), 1)
+        self.limit = float(min(max(initial, self.floor), self.ceiling))
+        self.goodput = 0.0
+        """Goodput (B/s) of the last completed round"""
+        self.error_rate = 0.0
+        """EWMA of part failures"""
+        self._round_bytes, self._round_parts, self._round_start = 0, 0, time.monotonic()
+
+    @property
+    def in_flight(self) -> int:
+        return int(self.limit)
+
+    def _clamp(self, limit):
+        self.limit = float(min(max(limit, self.floor), self.ceiling))
+
+    def on_success(self, nbytes: int):
+        self.error_rate *= 0.9
+        self._round_bytes += nbytes
+        self._round_parts += 1
+        if self._round_parts < self.in_flight:
+            return
+        now = time.monotonic()
+        goodput = self._round_bytes / max(now - self._round_start, 1e-6)
+        if goodput >= self.goodput * self.TOLERANCE:
+            self._clamp(self.limit + 1)
+        else:
+            self._clamp(self.limit - 1)
+        logger.debug("并发数: %d (%.2f MB/s)" % (self.in_flight, goodput / 1e6))
+        self.goodput = goodput
+        self._round_bytes, self._round_parts, self._round_start = 0, 0, now
+
+    def on_failure(self):
+        self.error_rate = self.error_rate * 0.9 + 0.1
+        self._clamp(self.limit * self.BACKOFF)
+        # the next round is measured from scratch
+        self.goodput = 0.0
+        self._round_bytes, self._round_parts, self._round_start = 0, 0, time.monotonic()
+        logger.debug("并发数: %d (失败率 %.2f)" % (self.in_flight, self.error_rate))
+
+
+class UploadLink:
+    """A local source address (i.e. an uplink) parts can be sent from,with its own accounting"""
+
+    def __init__(self, address: str) -> None:
+        self.address = address
+        self.in_flight = 0
+        self.sent = 0
+        """Bytes of parts uploaded through this link"""
+        self.parts_done = self.parts_failed = 0
+        self.meter = RateMeter()
+
+    @property
+    def rate(self) -> float:
+        """recent B/s"""
+        return self.meter.rate
+
+    def __repr__(self) -> str:
+        return "<UploadLink %s (%.2f MB/s)>" % (self.address, self.rate / 1e6)
+
+
+class UploadEngine:
+    """Drives upload parts of many jobs concurrently over one event loop
+
+    Chunks implement `async upload_async(engine, link) -> bool`, and may use `engine.transport`
+    for native asyncio requests or `engine.run_in_executor` for blocking ones.
+    Progress is published to `progress_bus`; streaming chunks report bytes with `engine.sent`.
+
+    Retries : a failed part is requeued at the tail of its job after an exponential backoff,
+    spending from the job's retry budget, rather than being retried by a blocked worker.
+    Parts going to an endpoint whose circuit breaker is open wait for it to cool down.
+
+    Growing sources : parts of a source still being written aren't scheduled until their bytes
+    are written (see `GrowingSource`), so they neither hold a worker while waiting nor count the
+    wait towards their latency; other jobs' parts go first meanwhile.
+
+    Page cache : the part after the one being sent is hinted to be read ahead, and parts
+    are dropped from the page cache once uploaded (see `FileManager`).
+
+    Memory : every part attempt reserves `chunk.footprint` bytes from `buffer_pool` first,
+    waiting while the process-wide memory budget is used up.
+
+    Links : with `source_addresses` given, every part attempt is sent from the link with the
+    fewest parts in flight (the faster one on ties), so faster links end up carrying more.
+    The chosen `UploadLink` is passed to `upload_async`, None without any.
+
+    Failover : jobs with `failover` set are aborted when their endpoint degrades, and
+    `upload_job` raises `UploadAborted` so the owner can restart them on another endpoint.
+
+    Tail hedging : once a job has nothing left to schedule and at most `HEDGE_TAIL_PARTS`
+    parts in flight, a part running longer than `HEDGE_MULTIPLIER` times the job's
+    `HEDGE_QUANTILE` latency gets a duplicate send. The first success wins.
+    """
+
+    HEDGE_TAIL_PARTS = 2
+    HEDGE_QUANTILE = 0.9
+    HEDGE_MULTIPLIER = 1.5
+    HEDGE_MIN_SAMPLES = 4
+    """Parts that must have finished before latency is trusted"""
+    HEDGE_POLL_INTERVAL = 1
+
+    FAILOVER_MIN_PARTS = 8
+    """Part attempts a job must have made before its error rate is trusted"""
+    FAILOVER_ERROR_RATE = 0.5
+    FAILOVER_WINDOW = 60
+    FAILOVER_MIN_GOODPUT = 32 * 1024
+    """A job with `failover` set is aborted once its error rate exceeds `FAILOVER_ERROR_RATE`,
+    its goodput over `FAILOVER_WINDOW` seconds falls below `FAILOVER_MIN_GOODPUT` B/s,
+    or its endpoint's circuit breaker opens"""
+
+    RETRY_BUDGET_RATIO = 0.5
+    RETRY_BUDGET_MIN = 10
+    """A job may spend max(`RETRY_BUDGET_MIN`, `RETRY_BUDGET_RATIO` * parts) retries in total"""
+
+    def __init__(
+        self,
+        workers: int = 3,
+        policy: str = UploadScheduler.POLICY_WFQ,
+        workers_min: int = 1,
+        workers_max: int = 32,
+        hedging: bool = True,
+        retry: RetryPolicy = None,
+        source_addresses: Iterable[str] = (),
+    ) -> None:
+        """
+        Args:
+            workers (int, optional): 初始并发分块数. Defaults to 3.
+            policy (str, optional): 多任务调度策略. Defaults to wfq.
+            workers_min, workers_max (int, optional): 并发分块数上下限. Defaults to 1 - 32.
+            hedging (bool, optional): 是否为末尾慢分块重复发送. Defaults to True.
+            retry (RetryPolicy, optional): 分块重试策略. Defaults to RetryPolicy().
+            source_addresses (Iterable[str], optional): 分块分散使用的本地地址（出口）. Defaults to 默认路由.
+        """
+        self.links = [UploadLink(address) for address in source_addresses]
+        self.hedging = hedging
+        self.retry = retry or RetryPolicy()
+        self.controller = ConcurrencyController(workers, workers_min, workers_max)
+        self.scheduler = UploadScheduler(policy)
+        self.transport = AsyncHTTPTransport()
+        self._tasks = set()
+        self._watchers: Dict[UploadJob, asyncio.Task] = dict()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def run_in_executor(self, func, *args, on_cancel=None, **kwargs):
+        """runs blocking `func` in the loop's default executor
+
+        Threads can't be interrupted : once cancelled,this calls `on_cancel` (which should make
+        `func` return early) and still waits for `func` to return before raising. So what's held
+        for it,e.g. the part's reservation from `buffer_pool`,is only released once it's done.
+        """
+        future = asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if on_cancel:
+                on_cancel()
+            while not future.done():
+                try:
+                    await asyncio.wait([future])
+                except asyncio.CancelledError:
+                    pass  # cancelled again,still waiting on the thread
+            if not future.cancelled():
+                future.exception()  # retrieved,it's of no interest any more
+            raise
+
+    @property
+    def jobs(self) -> List[UploadJob]:
+        return self.scheduler.jobs
+
+    def sent(self, chunk, nbytes: int):
+        """reports `nbytes` more bytes of `chunk` as sent,for chunks that stream their body"""
+        progress_bus.publish(ProgressBus.PART_SENT, chunk.job, chunk, nbytes)
+
+    @property
+    def workers(self) -> int:
+        """current limit of in-flight parts"""
+        return self.controller.in_flight
+
+    def _spawn_workers(self):
+        while len(self._tasks) < self.workers and self.scheduler.pending:
+            task = asyncio.ensure_future(self._worker())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        for job in self.scheduler.waiting:
+            if job not in self._watchers:
+                self._watchers[job] = asyncio.ensure_future(self._watch(job))
+
+    async def _watch(self, job: UploadJob):
+        """waits until the next part of `job` can be read,then puts workers onto it"""
+        try:
+            while job in self.scheduler.jobs and job.chunks and not job.chunks[0].ready:
+                try:
+                    await job.chunks[0].wait_ready()
+                except IOError:
+                    pass  # the part fails once a worker takes it
+        finally:
+            self._watchers.pop(job, None)
+        self._spawn_workers()
+
+    def _finish(self, job: UploadJob):
+        if not job.chunks and job.in_flight == job.backoff == 0 and not job.finished.done():
+            self.scheduler.remove(job)
+            job.finished.set_result(job.parts_failed == 0)
+            progress_bus.publish(ProgressBus.JOB_DONE, job)
+
+    def _hedge_delay(self, job: UploadJob, elapsed: float):
+        """seconds until a part running for `elapsed` should be hedged,None if it never should"""
+        if not self.hedging or len(job.latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        threshold = job.latency_quantile(self.HEDGE_QUANTILE) * self.HEDGE_MULTIPLIER
+        if job.chunks or job.in_flight > self.HEDGE_TAIL_PARTS:
+            # not at the tail yet
+            return max(threshold - elapsed, self.HEDGE_POLL_INTERVAL)
+        return max(threshold - elapsed, 0)
+
+    def _check_health(self, job: UploadJob, success: bool, nbytes: int = 0):
+        """tracks a part attempt of `job`,aborting the job if its endpoint degraded"""
+        job.attempts += 1
+        job.error_rate = job.error_rate * 0.9 + (0 if success else 0.1)
+        job._window_bytes += nbytes
+        if not job.failover or job.aborted:
+            return
+        reason = None
+        now = time.monotonic()
+        elapsed = now - job._window_start
+        if job.attempts >= self.FAILOVER_MIN_PARTS and job.error_rate > self.FAILOVER_ERROR_RATE:
+            reason = "失败率 %.2f" % job.error_rate
+        elif elapsed > self.FAILOVER_WINDOW:
+            goodput = job._window_bytes / elapsed
+            # a slow job may as well be held back by our own bandwidth limit,or by its source
+            paced = governor.rate(governor.UP) or getattr(job.path, "PACED", False)
+            if goodput < self.FAILOVER_MIN_GOODPUT and not paced:
+                reason = "速度 %.2f KB/s" % (goodput / 1024)
+            job._window_start, job._window_bytes = now, 0
+        if reason:
+            self._abort(job, reason)
+
+    def _abort(self, job: UploadJob, reason: str):
+        if job.aborted:
+            return
+        logger.warning("%s 的上传结点状况不佳 (%s)，放弃该结点" % (job, reason))
+        job.abort(reason)
+        self._finish(job)
+
+    def _pick_link(self) -> UploadLink:
+        if not self.links:
+            return None
+        return min(self.links, key=lambda link: (link.in_flight, -link.rate))
+
+    async def _attempt(self, chunk) -> bool:
+        """one send of `chunk` within the memory budget"""
+        footprint = chunk.footprint
+        await buffer_pool.reserve_async(footprint)
+        try:
+            return await self._attempt_on_link(chunk)
+        finally:
+            buffer_pool.release(footprint)
+
+    async def _attempt_on_link(self, chunk) -> bool:
+        """one send of `chunk` through the least busy link"""
+        link = self._pick_link()
+        if link is None:
+            return await chunk.upload_async(self, None)
+        link.in_flight += 1
+        try:
+            success = await chunk.upload_async(self, link)
+        except BaseException:
+            link.parts_failed += 1
+            raise
+        finally:
+            link.in_flight -= 1
+        if success:
+            link.parts_done += 1
+            link.sent += len(chunk)
+            link.meter.add(len(chunk), time.monotonic())
+        return success
+
+    def _requeue_later(self, chunk, delay: float):
+        job: UploadJob = chunk.job
+        job.backoff += 1
+
+        def requeue():
+            job.backoff -= 1
+            job.requeue(chunk)
+            self._finish(job)  # aborted meanwhile
+            self._spawn_workers()
+
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    async def _upload_part(self, chunk) -> bool:
+        """sends `chunk` through its endpoint's circuit breaker,racing a duplicate send
+        against it when it straggles at the tail
+
+        Raises:
+            CircuitOpenError
+        """
+        job: UploadJob = chunk.job
+        breaker = breakers[urlsplit(chunk.url_endpoint).netloc]
+        breaker.check()
+        start = time.monotonic()
+        progress_bus.publish(ProgressBus.PART_START, job, chunk)
+        attempts = {asyncio.ensure_future(self._attempt(chunk))}
+        hedged = False
+        try:
+            while attempts:
+                delay = None if hedged else self._hedge_delay(job, time.monotonic() - start)
+                if delay == 0:
+                    logger.debug("分块 %s 用时过长，重复发送" % chunk.params.get("partNumber"))
+                    progress_bus.publish(ProgressBus.PART_START, job, chunk)
+                    attempts.add(asyncio.ensure_future(self._attempt(chunk)))
+                    hedged = True
+                    continue
+                done, attempts = await asyncio.wait(
+                    attempts, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                for attempt in done:
+                    if not attempt.exception() and attempt.result():
+                        job.latencies.append(time.monotonic() - start)
+                        breaker.record_success()
+                        return True
+                    if attempt.exception():
+                        logger.warning("分块上传出错：%s" % attempt.exception())
+            breaker.record_failure()
+            return False
+        except BaseException:
+            breaker.release()  # cancelled,no outcome to record
+            raise
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def _worker(self):
+        try:
+            await self._work()
+        finally:
+            # leaves the pool right away,so that the workers left never all see a full pool & quit
+            self._tasks.discard(asyncio.current_task())
+
+    async def _work(self):
+        while len(self._tasks) <= self.workers:  # leaves when the limit shrinks
+            chunk = self.scheduler.next()
+            if chunk is None:
+                return
+            job: UploadJob = chunk.job
+            job.in_flight += 1
+            job.readahead()
+            delay, circuit_open = None, False
+            try:
+                await chunk.wait_ready()
+                success = await self._upload_part(chunk)
+            except CircuitOpenError as e:
+                # doesn't count as a failure of this part
+                success, delay, circuit_open = False, e.retry_after, True
+            except IOError as e:
+                if not job.aborted:
+                    logger.warning("分块 %s 不可读：%s" % (chunk.params.get("partNumber"), e))
+                success = False
+            job.in_flight -= 1
+            if success:
+                job.parts_done += 1
+                job.file_manager.dontneed(job.path, chunk.start, chunk.end)
+                self.controller.on_success(len(chunk))
+                for callback in job.on_part_done:
+                    callback(chunk)
+                progress_bus.publish(ProgressBus.PART_DONE, job, chunk)
+            elif circuit_open:
+                self._requeue_later(chunk, delay)  # never sent,so no attempt is spent
+                progress_bus.publish(ProgressBus.PART_RETRY, job, chunk)
+            elif chunk.attempts + 1 < self.retry.retries and job.budget.spend():
+                chunk.attempts += 1
+                self.controller.on_failure()
+                self._requeue_later(chunk, self.retry.backoff(chunk.attempts - 1))
+                progress_bus.publish(ProgressBus.PART_RETRY, job, chunk)
+            else:
+                job.parts_failed += 1
+                job.failed.append(chunk)
+                self.controller.on_failure()
+                progress_bus.publish(ProgressBus.PART_FAILED, job, chunk)
+                logger.error("分块 %s 重试后仍失败" % chunk.params.get("partNumber"))
+            if circuit_open:
+                if job.failover:
+                    self._abort(job, "熔断")
+            else:
+                self._check_health(job, success, len(chunk) if success else 0)
+            self._finish(job)
+            self._spawn_workers()  # the limit may have grown
+
+    async def upload_job(self, job: UploadJob) -> bool:
+        """schedules `job` alongside other active jobs and waits until all its parts are done
+
+        A job whose parts failed may be uploaded again after `UploadJob.redrive`
+
+        Returns:
+            bool: True if every part succeeded
+
+        Raises:
+            UploadAborted: 结点状况不佳，任务被放弃时引发
+        """
+        job.finished = asyncio.get_running_loop().create_future()
+        job.budget = RetryBudget(
+            max(self.RETRY_BUDGET_MIN, int(job.parts_total * self.RETRY_BUDGET_RATIO))
+        )
+        self.scheduler.add(job)
+        progress_bus.publish(ProgressBus.JOB_START, job)
+        self._finish(job)  # jobs without any part
+        self._spawn_workers()
+        try:
+            success = await job.finished
+        except asyncio.CancelledError:
+            job.abort("已取消")  # parts in flight are left to finish
+            self.scheduler.remove(job)
+            progress_bus.publish(ProgressBus.JOB_DONE, job)
+            raise
+        if job.aborted:
+            raise UploadAborted(job.aborted)
+        return success
+
+    async def close(self):
+        for task in [*self._tasks, *self._watchers.values()]:
+            task.cancel()
+        await self.transport.close()
@@ -1,20 +1,36 @@
 # -*- coding: utf-8 -*-
 """bilibili - Web API implmentation"""
 from functools import wraps
-from concurrent.futures.thread import ThreadPoolExecutor
 import json, pickle, gzip
-from threading import Thread
 from requests import Session
+from requests.utils import get_environ_proxies
 from typing import List, Tuple
-import math, time, mimetypes, base64, logging
+from urllib.parse import parse_qs, urlsplit
+import asyncio, math, os, time, mimetypes, base64, logging
 
 from bilibili_toolman.bilisession.common import (
     JSONResponse,
     FileIterator,
     ReprExDict,
-    file_manager,
-    chunk_queue,
     check_file,
+    file_key,
+    open_source,
+)
+from bilibili_toolman.bilisession.common.bandwidth import BandwidthGovernor, governor
+from bilibili_toolman.bilisession.common.cdn import CDNProbe, cdn_rankings, network_key
+from bilibili_toolman.bilisession.common.dedupe import UploadIndex, fingerprint
+from bilibili_toolman.bilisession.common.journal import UploadJournal
+from bilibili_toolman.bilisession.common.retry import RetryPolicy
+from bilibili_toolman.bilisession.common.service import upload_service
+from bilibili_toolman.bilisession.common.shards import ShardedUpload
+from bilibili_toolman.bilisession.common.sources import GrowingSource
+from bilibili_toolman.bilisession.common.transport import FileRange, SourceAddressAdapter, StallWatchdog
+from bilibili_toolman.bilisession.common.upload import (
+    UploadAborted,
+    UploadEngine,
+    UploadJob,
+    UploadLink,
+    UploadScheduler,
 )
 from bilibili_toolman.bilisession.common.submission import Submission, create_submission_by_arc
 
@@ -35,18 +51,72 @@ class WebUploadChunk(FileIterator):
     session: Session
 
     def upload_via_session(self, session=None):
-        for retries in range(1, BiliSession.RETRIES_UPLOAD_ID + 1):
-            try:
-                resp = (session or self.session).put(
-                    self.url_endpoint,
+        """sends this part once with `requests`,retries are up to the upload engine"""
+        governor.acquire(governor.UP, len(self), self.job.priority)
+        resp = (session or self.session).put(
+            self.session._rewrite_url(self.url_endpoint),
+            params=self.params,
+            headers=self.headers,
+            data=StallWatchdog(
+                self, self.session.MIN_UPLOAD_THROUGHPUT, self.session.TIMEOUTS["part"][1]
+            ),
+            timeout=self.session.TIMEOUTS["part"],
+        )
+        assert resp.ok, "HTTP %s : %s" % (resp.status_code, resp.text)
+        return True
+
+    async def upload_async(self, engine: UploadEngine, link: UploadLink = None):
+        if not self.session._native_transport_usable(self.url_endpoint):
+            # proxies are only honored by `requests`
+            self.cancelled = False
+            return await engine.run_in_executor(
+                self.upload_via_session, self.session._link_session(link), on_cancel=self.cancel
+            )
+        local_addr = link.address if link else None
+        url = self.session._rewrite_url(self.url_endpoint)
+        headers = {"User-Agent": self.session.headers["User-Agent"], **self.headers}
+        if self.session.UPLOAD_SENDFILE and url[:5] == "http:" and isinstance(self.path, str):
+            # plain TCP : zero-copy from the file descriptor
+            await governor.acquire_async(governor.UP, len(self), self.job.priority)
+            with open(self.path, "rb") as file:
+                resp = await engine.transport.request(
+                    "PUT",
+                    url,
                     params=self.params,
-                    headers=self.headers,
-                    data=self,
+                    headers=headers,
+                    body=FileRange(file, self.start, len(self)),
+                    timeout=self.session.TIMEOUTS["part"],
+                    min_throughput=self.session.MIN_UPLOAD_THROUGHPUT,
+                    local_addr=local_addr,
                 )
-                return True
-            except Exception as e:
-                self.logger.warning("第 %s 次重试时：%s" % (retries, e))
-        return False
+            self.file_manager.account(self.path, len(self))
+            engine.sent(self, len(self))
+        else:
+
+            async def body():
+                async for piece in self.iter_async():
+                    await governor.acquire_async(governor.UP, len(piece), self.job.priority)
+                    yield piece
+                    engine.sent(self, len(piece))
+
+            resp = await engine.transport.request(
+                "PUT",
+                url,
+                params=self.params,
+                headers=headers,
+                body=body,  # a new iteration per send,so it can be sent again
+                length=len(self),
+                timeout=self.session.TIMEOUTS["part"],
+                min_throughput=self.session.MIN_UPLOAD_THROUGHPUT,
+                local_addr=local_addr,
+            )
+        assert resp.ok, "HTTP %s : %s" % (resp.status_code, resp.text)
+        return True
+
+class SubmissionRateLimited(Exception):
+    def __init__(self, result: dict) -> None:
+        self.result = result
+        super().__init__("请求受限（限流）: %s" % result.get("message"))
 
 class BiliSession(Session):
     """哔哩哔哩网页上传 API"""
@@ -62,27 +132,93 @@ class BiliSession(Session):
 
     UPLOAD_PROFILE = "ugcupos/bup"
     UPLOAD_CDN = "bda2"
+    UPLOAD_CDN_AUTO = False
+    """Upload through the fastest CDN found by probing,`UPLOAD_CDN` is then only a fallback"""
+    UPLOAD_CDN_CANDIDATES = None
+    """CDNs allowed to be probed,None for every one offered"""
+    UPLOAD_FAILOVER = True
+    UPLOAD_FAILOVERS = 2
+    """Times an upload may restart on another CDN once its node degrades"""
+    UPLOAD_CDN_FAILOVER = ("bda2", "qn", "ws")
+    """CDNs failed over to in order,unless `UPLOAD_CDN_AUTO` ranks them"""
+    CDN_PROBE_SIZE = 1 << 20
+    """Bytes sent to every CDN to measure goodput"""
+    CDN_PROBE_TTL = 3600
+    """Seconds a CDN ranking is reused on the same network"""
 
     RETRIES_UPLOAD_ID = 5
+    RETRIES_UPLOAD_VIDEO = 3
+    """Rounds of re-uploading parts that ran out of retries,within the same upload session"""
 
     DELAY_FETCH_UPLOAD_ID = 0.1
+    TIMEOUT_FETCH_UPLOAD_ID = 5
+    """A new upload's `auth` token takes a moment to be valid server-side, so rejected upload ID
+    requests are retried from `DELAY_FETCH_UPLOAD_ID` seconds on, doubling, for up to this long"""
     DELAY_RETRY_UPLOAD_ID = 1
-    DELAY_REPORT_PROGRESS = 1
+    DELAY_RETRY_MAX = 60
+    """Retries back off exponentially from `DELAY_RETRY_*` up to this many seconds"""
 
     RETRIES_VIDEO_SUBMISSION = 5
     DELAY_VIDEO_SUBMISSION = 30
+    SUBMISSION_RATE_LIMITED_CODES = {21070, 21186}
 
     WORKERS_UPLOAD = 3
+    WORKERS_UPLOAD_MIN = 1
+    WORKERS_UPLOAD_MAX = 32
+    """In-flight parts start at `WORKERS_UPLOAD` and adapt to the link within these limits"""
+    UPLOAD_HEDGING = True
+    """Re-send straggling parts at the tail of an upload"""
+    UPLOAD_SENDFILE = True
+    """Send parts with `sendfile` over plain HTTP (e.g. `FORCE_HTTP`),buffered otherwise"""
+    UPLOAD_SOURCE_ADDRESSES = ()
+    """Local addresses (one per uplink) parts are spread across,default route if empty"""
+    UPLOAD_PROCESSES = 1
+    """Processes the parts of every upload are sharded across (see `ShardedUpload`),1 to upload in-process"""
+    UPLOAD_POLICY = UploadScheduler.POLICY_WFQ
+    """Scheduling among concurrent uploads : wfq (weighted-fair) or sjf (shortest-job-first)"""
+
+    UPLOAD_JOURNAL = None
+    """Path of the journal that lets interrupted uploads resume,None to disable"""
+    UPLOAD_JOURNAL_TTL = 12 * 3600
+    """Seconds an upload session is assumed valid for server-side"""
+    UPLOAD_INDEX = None
+    """Path of the index of uploaded files,which lets identical files skip uploading,None to disable"""
+    UPLOAD_INDEX_TTL = 24 * 3600
+    """Seconds an uploaded file is assumed usable for submissions"""
+    UPLOAD_INDEX_FULL_HASH = False
+    """Fingerprint files by their whole content as well,instead of sampled blocks only"""
 
     MISC_MAX_TITLE_LENGTH = 80
     MISC_MAX_DESCRIPTION_LENGTH = 2000
 
     FORCE_HTTP = False
 
-    def request(self, method: str, url, *a, **k):
+    TIMEOUTS = {
+        "api": (10, 30),
+        "upos": (10, 60),
+        "part": (10, 60),
+    }
+    """(connect, read) timeouts in seconds per endpoint class : `api` for bilibili APIs,
+    `upos` for upload node handshakes, `part` for every upload part"""
+    MIN_UPLOAD_THROUGHPUT = 4 * 1024
+    """B/s. Parts sent slower than this are aborted and requeued"""
+
+    def _rewrite_url(self, url: str):
         if self.FORCE_HTTP and url[:5] == "https":
             url = "http" + url[5:]
-        return super().request(method, url, *a, **k)
+        return url
+
+    def _native_transport_usable(self, url: str):
+        """whether `url` can be reached without the proxies configured for `requests`"""
+        return not (self.proxies or (self.trust_env and get_environ_proxies(url)))
+
+    def _endpoint_class(self, url: str):
+        host = urlsplit(url).hostname or ""
+        return "upos" if "upos" in host or "bilivideo" in host else "api"
+
+    def request(self, method: str, url, *a, **k):
+        k.setdefault("timeout", self.TIMEOUTS[self._endpoint_class(url)])
+        return super().request(method, self._rewrite_url(url), *a, **k)
 
     def __init__(self, cookies="") -> None:
         Session.__init__(self)
@@ -117,7 +253,7 @@ class BiliSession(Session):
         return self._self()
 
     @JSONResponse
-    def _upload_status(self, endpoint, name, upload_id, biz_id):
+    def _upload_status(self, endpoint, name, upload_id, biz_id, auth=None):
         """检查网页端上传结果，限网页端使用"""
         return self.post(
             endpoint,
@@ -128,6 +264,7 @@ class BiliSession(Session):
                 "uploadId": upload_id,
                 "biz_id": biz_id,
             },
+            headers={"X-Upos-Auth": auth} if auth else None,
         )
 
     def _list_archives(self, params):
@@ -272,7 +409,7 @@ class BiliSession(Session):
                 add_to_submissions(self.ListArchives(*args, pn=pn)["data"])
         return submissions
 
-    def _preupload(self, name="a.flv", size=0):
+    def _preupload(self, name="a.flv", size=0, upcdn=None):
         return self.get(
             "https://member.bilibili.com/preupload",
             params={
@@ -283,109 +420,416 @@ class BiliSession(Session):
                 "ssl": 0,
                 "version": self.BUILD_STR,
                 "build": self.BUILD_NO,
-                "upcdn": self.UPLOAD_CDN,
+                "upcdn": upcdn or self.UPLOAD_CDN,
                 "probe_version": self.BUILD_NO,
             },
         )
 
-    def _upload_id(self, endpoint):
-        time.sleep(
-            self.DELAY_FETCH_UPLOAD_ID
-        )  # adding delay as the `auth` token needs to be updated server-side
-        return self.post(
-            endpoint + "?uploads",
-            params={"output": "json"},
-            headers={
-                "Origin": "https://member.bilibili.com",
-                "Referer": "https://member.bilibili.com/",
+    def _probe_lines(self):
+        return self.get(
+            "https://member.bilibili.com/preupload",
+            params={
+                "r": "probe",
+                "version": self.BUILD_STR,
+                "build": self.BUILD_NO,
+                "probe_version": self.BUILD_NO,
             },
         )
 
-    def _upload_chunks_to_endpoint_blocking(self, chunk_iter: List[WebUploadChunk]):
+    def _probe_cdn(self, line: dict) -> CDNProbe:
+        """measures RTT with an empty request,then goodput with a `CDN_PROBE_SIZE` burst"""
+        cdn = parse_qs(line.get("query", "")).get("upcdn", [None])[0]
+        url = "https:" + line["probe_url"]
+        start = time.monotonic()
+        resp = self.get(url)
+        rtt = time.monotonic() - start
+        assert resp.ok, "HTTP %s : %s" % (resp.status_code, resp.text)
+        start = time.monotonic()
+        resp = self.post(url, data=bytes(self.CDN_PROBE_SIZE))
+        elapsed = time.monotonic() - start
+        assert resp.ok, "HTTP %s : %s" % (resp.status_code, resp.text)
+        return CDNProbe(cdn, rtt, self.CDN_PROBE_SIZE / max(elapsed - rtt, elapsed / 2))
+
+    def _probe_cdns(self) -> List[CDNProbe]:
+        probes = []
+        for line in self._probe_lines().json().get("lines", []):
+            try:
+                probe = self._probe_cdn(line)
+            except Exception as e:
+                self.logger.warning("CDN %s 测速失败：%s" % (line.get("query"), e))
+                continue
+            if probe.cdn and (
+                not self.UPLOAD_CDN_CANDIDATES or probe.cdn in self.UPLOAD_CDN_CANDIDATES
+            ):
+                probes.append(probe)
+        return probes
+
+    def RankCDNs(self) -> List[CDNProbe]:
+        """测速并排序可用上传 CDN，结果在同一网络下缓存 `CDN_PROBE_TTL` 秒
+
+        Returns:
+            List[CDNProbe]: 由快至慢
+        """
+        network = network_key(proxies=str(self.proxies or ""))
+        return cdn_rankings.rank(network, self._probe_cdns, self.CDN_PROBE_TTL)
+
+    def _select_cdn(self, exclude=()) -> str:
+        """CDN for the next upload,preferring ones not in `exclude`"""
+        candidates = [self.UPLOAD_CDN]
+        if self.UPLOAD_CDN_AUTO:
+            try:
+                ranking = self.RankCDNs()
+            except Exception as e:
+                self.logger.warning("CDN 测速失败：%s" % e)
+                ranking = []
+            if ranking:
+                candidates = [p.cdn for p in ranking]
+            else:
+                self.logger.warning("无可用 CDN 测速结果，使用 %s" % self.UPLOAD_CDN)
+        elif self.UPLOAD_PROFILE == "ugcupos/bup":
+            candidates += [cdn for cdn in self.UPLOAD_CDN_FAILOVER if cdn != self.UPLOAD_CDN]
+        for cdn in candidates:
+            if cdn not in exclude:
+                return cdn
+        return candidates[0]
+
+    def _upload_id(self, endpoint, auth=None):
+        delay, deadline = self.DELAY_FETCH_UPLOAD_ID, time.monotonic() + self.TIMEOUT_FETCH_UPLOAD_ID
+        while True:
+            resp = self.post(
+                endpoint + "?uploads",
+                params={"output": "json"},
+                headers={
+                    "Origin": "https://member.bilibili.com",
+                    "Referer": "https://member.bilibili.com/",
+                    **({"X-Upos-Auth": auth} if auth else {}),
+                },
+            )
+            # rejected until the `auth` token is updated server-side. other errors are up to the caller
+            if resp.ok or resp.status_code >= 500 or time.monotonic() + delay > deadline:
+                return resp
+            time.sleep(delay)
+            delay *= 2
+
+    async def _handshake(self, path: str, exclude=(), upcdn: str = None) -> Tuple[dict, str]:
+        """preupload & upload ID of `path` on `upcdn`,or the best CDN not in `exclude`
+
+        Returns:
+            Tuple[dict,str]: [上传配置,上传结点 URL]
+        """
+        path, basename, size = check_file(path)
+        loop = asyncio.get_running_loop()
+        upcdn = upcdn or await loop.run_in_executor(None, self._select_cdn, exclude)
+        resp = await loop.run_in_executor(
+            None, lambda: self._preupload(name=basename, size=size, upcdn=upcdn)
+        )
+        config = resp.json()
+        config["upcdn"] = upcdn
+        endpoint = "https:%s/%s" % (
+            config["endpoint"],
+            config["upos_uri"].split('upos://')[-1]
+        )
+        self.logger.info("远端结点： %s (%s)" % (endpoint, upcdn))
+        # https://upos-cs-upcdnbda2.bilivideo.com/ugcfx2lf/
+        # n220728a288v9obhmjrsgy8g3mf0rpuu.mp4?
+        # uploads&output=json&profile=ugcfx%2Fbup&filesize=1008319211&
+        # partsize=10485760&
+        # meta_upos_uri=upos%3A%2F%2Ffxmeta%2Fn220728a2uy50rqfrx1kz2xenwwshgaq.txt&biz_id=786176430
+        #
+        resp = await loop.run_in_executor(
+            None, self._upload_id, endpoint, config["auth"]
+        )
+        assert resp.ok, "HTTP %s : %s" % (resp.status_code, resp.text)
+        config["upload_id"] = resp.json()["upload_id"]
+        return config, endpoint
+
+    async def _warm_connections(self, endpoint: str):
+        """opens as many connections to `endpoint` as parts will be sent at once,across all links"""
+        url = self._rewrite_url(endpoint)
+        if not self._native_transport_usable(url):
+            return 0  # `requests` pools its own,and the handshake warmed one already
+        engine = self._upload_engine()
+        links = [link.address for link in engine.links] or [None]
+        count = math.ceil(engine.workers / len(links))
+        warmed = await asyncio.gather(
+            *(
+                engine.transport.warm(url, count, address, self.TIMEOUTS["part"][0])
+                for address in links
+            )
+        )
+        return sum(warmed)
+
+    async def _handshake_with_retry(self, path: str, exclude=()) -> Tuple[dict, str]:
+        """`_handshake` with retries,through the circuit breaker of the CDN picked"""
+        upcdn = await asyncio.get_running_loop().run_in_executor(None, self._select_cdn, exclude)
+        return await self.upload_retry_policy.run_async(
+            self._handshake, path, exclude, upcdn=upcdn, key="preupload:%s" % upcdn
+        )
+
+    async def _prefetch_handshake(self, path: str):
+        handshake = await self._handshake_with_retry(path)
+        try:
+            self.logger.debug("已预热 %s 个连接" % await self._warm_connections(handshake[1]))
+        except Exception as e:
+            self.logger.debug("连接预热失败：%s" % e)
+        return handshake
+
+    def PrefetchUpload(self, path: str):
+        """在后台预先为即将上传的视频完成握手（获取上传 TOKEN）并预热连接，与当前上传重叠进行
+
+        之后 `UploadVideo(path)` 将直接使用该握手结果
+
+        Args:
+            path (str): 视频文件路径，亦可为 URL (http(s)://，s3://) 或 `UploadSource`
+        """
+        handshakes = getattr(self, "_handshakes", None)
+        if handshakes is None:
+            handshakes = self._handshakes = dict()
+        if isinstance(path, str) and os.path.abspath(path) in getattr(self, "_streams", {}):
+            return  # being uploaded already
+        path = open_source(path)
+        key = file_key(path)
+        if key not in handshakes:
+            handshakes[key] = upload_service.submit(self._prefetch_handshake(path))
+
+    def StreamUpload(self, path: str, size: int, partial: str = None):
+        """边写边传：在文件仍在写入（如下载中）时即开始上传，分块写入后即上传
+
+        之后 `UploadVideo(path)` 将等待该上传完成；若文件最终大小与 `size` 不符，则取消该上传并重新上传
+
+        Args:
+            path (str): 文件最终路径
+            size (int): 文件最终大小 (B)，须事先确知
+            partial (str, optional): 写入中的临时文件路径. Defaults to path + '.part'.
+        """
+        streams = getattr(self, "_streams", None)
+        if streams is None:
+            streams = self._streams = dict()
+        source = GrowingSource(path, size, partial)
+        if source.path not in streams:
+            streams[source.path] = (source, upload_service.submit(self.UploadVideoAsync(source)))
+
+    def CancelStreamUploads(self):
+        """取消所有未被 `UploadVideo` 取用的边写边传上传（如下载失败时）"""
+        for source, future in getattr(self, "_streams", {}).values():
+            future.cancel()
+            source.fail("已取消")  # releases parts waiting on it
+        self._streams = dict()
+
+    async def _take_stream(self, path: str):
+        """result of the `StreamUpload` of `path`,None if there's none or it can't be used.
+        Raises `FileNotFoundError` if the file it was streaming never showed up"""
+        if not isinstance(path, str):
+            return None
+        stream = getattr(self, "_streams", {}).pop(os.path.abspath(path), None)
+        if stream is None:
+            return None
+        source, future = stream
+        if not os.path.isfile(path):  # the download didn't complete
+            future.cancel()
+            source.fail("文件不存在")
+            raise FileNotFoundError("边写边传的文件 %s 不存在，其下载可能已失败" % path)
+        if os.path.getsize(path) != source.size:
+            self.logger.warning("%s 最终大小与预期不符，重新上传" % source.name)
+            future.cancel()
+            source.fail("大小不符")
+            return None
+        try:
+            return await asyncio.wrap_future(future)
+        except Exception as e:
+            self.logger.warning("边写边传失败，重新上传：%s" % e)
+            return None
+
+    async def _take_handshake(self, path: str):
+        """the handshake `PrefetchUpload` made for `path`,None if there's none or it failed"""
+        future = getattr(self, "_handshakes", {}).pop(file_key(path), None)
+        if future is None:
+            return None
+        try:
+            return await asyncio.wrap_future(future)
+        except Exception as e:
+            self.logger.warning("预先握手失败，重新获取 TOKEN：%s" % e)
+            return None
+
+    @property
+    def upload_retry_policy(self) -> RetryPolicy:
+        """retries of upload parts & handshakes"""
+        return RetryPolicy(self.RETRIES_UPLOAD_ID, self.DELAY_RETRY_UPLOAD_ID, self.DELAY_RETRY_MAX)
+
+    @property
+    def upload_journal(self) -> UploadJournal:
+        """journal of unfinished uploads at `UPLOAD_JOURNAL`,None if disabled"""
+        if not self.UPLOAD_JOURNAL:
+            return None
+        journal = getattr(self, "_journal", None)
+        if not journal or journal.path != os.path.abspath(os.path.expanduser(self.UPLOAD_JOURNAL)):
+            journal = self._journal = UploadJournal(self.UPLOAD_JOURNAL, self.UPLOAD_JOURNAL_TTL)
+        return journal
+
+    @property
+    def upload_index(self) -> UploadIndex:
+        """index of uploaded files at `UPLOAD_INDEX`,None if disabled"""
+        if not self.UPLOAD_INDEX:
+            return None
+        index = getattr(self, "_index", None)
+        if not index or index.path != os.path.abspath(os.path.expanduser(self.UPLOAD_INDEX)):
+            index = self._index = UploadIndex(self.UPLOAD_INDEX, self.UPLOAD_INDEX_TTL)
+        return index
+
+    @property
+    def _uploader(self) -> str:
+        """the account uploads are made by"""
+        return self.cookies.get("DedeUserID") or ""
+
+    async def _index_key(self, path) -> str:
+        """key of `path` in `upload_index`,None if disabled or `path` can't be fingerprinted"""
+        index = self.upload_index
+        if not index or getattr(path, "PACED", False):  # still being written
+            return None
+        try:
+            digest = await asyncio.get_running_loop().run_in_executor(
+                None, fingerprint, path, self.UPLOAD_INDEX_FULL_HASH
+            )
+        except Exception as e:
+            self.logger.warning("无法计算文件指纹：%s" % e)
+            return None
+        return index.key(digest, "%s|%s|%s" % (self.TYPE, self._uploader, self.UPLOAD_PROFILE))
+
+    async def _take_indexed(self, path):
+        """(index key,result of an earlier upload of identical content) for `path`"""
+        key = await self._index_key(path)
+        result = self.upload_index.lookup(key) if key else None
+        if result:
+            self.logger.info("相同文件已上传，跳过上传：%s" % result[0])
+            return key, tuple(result)
+        return key, None
+
+    def _record_indexed(self, key: str, result):
+        if not key:
+            return
+        try:
+            self.upload_index.record(key, list(result))
+        except Exception as e:
+            self.logger.warning("无法记录上传结果：%s" % e)
+
+    def ForgetUpload(self, path: str):
+        """从上传索引中移除该文件，下次上传时将重新上传（如其上传结果已无法投稿）
+
+        Args:
+            path (str): 视频文件路径，亦可为 URL (http(s)://，s3://) 或 `UploadSource`
+        """
+        if not self.upload_index:
+            return
+        path = check_file(path)[0]
+        key = self._run_blocking(self._index_key(path))
+        if key:
+            self.upload_index.forget(key)
+
+    def _link_session(self, link: UploadLink = None) -> Session:
+        """`requests` session sending from `link`,this session itself if None"""
+        if link is None:
+            return self
+        sessions = getattr(self, "_link_sessions", None)
+        if sessions is None:
+            sessions = self._link_sessions = dict()
+        if link.address not in sessions:
+            session = Session()
+            session.headers.update(self.headers)
+            session.proxies, session.trust_env = self.proxies, self.trust_env
+            adapter = SourceAddressAdapter(link.address)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            sessions[link.address] = session
+        return sessions[link.address]
+
+    def _upload_engine(self) -> UploadEngine:
+        """the upload engine of the running event loop,shared by all concurrent uploads"""
+        loop = asyncio.get_running_loop()
+        if getattr(self, "_engine_loop", None) is not loop:
+            self._engine = UploadEngine(
+                self.WORKERS_UPLOAD,
+                self.UPLOAD_POLICY,
+                self.WORKERS_UPLOAD_MIN,
+                self.WORKERS_UPLOAD_MAX,
+                self.UPLOAD_HEDGING,
+                self.upload_retry_policy,
+                self.UPLOAD_SOURCE_ADDRESSES,
+            )
+            self._engine_loop = loop
+            if loop is upload_service.loop:
+                upload_service.at_shutdown(self._engine.close)
+        return self._engine
+
+    def _run_blocking(self, coro):
+        """runs `coro` on the process-wide `upload_service`,blocks until done"""
+        return upload_service.run(coro)
+
+    async def _upload_chunks_to_endpoint(self, job: UploadJob):
+        """consuming all chunks of `job` alongside other uploads,progress goes to `progress_bus`
+
+        Parts that still fail after their retries are re-uploaded for up to `RETRIES_UPLOAD_VIDEO`
+        rounds against the same upload session. With `UPLOAD_PROCESSES` > 1 the parts are
+        sharded across that many processes, each doing the above for its own share
+
+        Raises:
+            Exception: 仍有分块上传失败时引发
+        """
+        if self.UPLOAD_PROCESSES > 1:
+            return await ShardedUpload(self, self.UPLOAD_PROCESSES).run(job)
+        engine = self._upload_engine()
+        policy = self.upload_retry_policy
+        for attempt in range(max(self.RETRIES_UPLOAD_VIDEO, 1)):
+            if attempt:
+                await asyncio.sleep(policy.backoff(attempt - 1))
+                self.logger.warning("重新上传 %s 个失败分块" % job.redrive())
+            if await engine.upload_job(job):
+                return True
+            self.logger.error("%s 个分块上传失败" % job.parts_failed)
+        raise Exception(
+            "经 %s 轮上传后仍有 %s 个分块上传失败" % (self.RETRIES_UPLOAD_VIDEO, job.parts_failed)
+        )
+
+    def _upload_chunks_to_endpoint_blocking(self, job: UploadJob):
         """consuming all chunks through any means,blocks code until done"""
-        for chunk in chunk_iter:
-            chunk_queue.put(chunk)
-        executor = ThreadPoolExecutor(max_workers=self.WORKERS_UPLOAD)
-
-        class ConsumerThread(Thread):
-            daemon = True
-            dirty = False
-
-            def run(self) -> None:
-                while chunk_queue.unfinished_tasks >= 0:
-                    chunk: WebUploadChunk = chunk_queue.get()
-                    future = executor.submit(chunk.upload_via_session)
-
-                    def cb(future):
-                        if not future._result:
-                            self.dirty = True
-                        chunk_queue.task_done()
-
-                    future.add_done_callback(cb)
-
-        tConsume = ConsumerThread()
-        tConsume.start()
-        from bilibili_toolman import cli
-
-        while chunk_queue.unfinished_tasks >= 0:
-            read_all, size_all = 0, 0
-            for v in file_manager.values():
-                read_all += v["read"]
-                size_all += v["length"]
-            cli.report_progress(read_all, size_all)
-            if chunk_queue.unfinished_tasks == 0:
-                break
-            time.sleep(self.DELAY_REPORT_PROGRESS)
-        if tConsume.dirty:
-            self.logger.error("部分上传分块存在问题，稿件可能永不过审!")  # oh no
-        return True
+        return self._run_blocking(self._upload_chunks_to_endpoint(job))
 
-    def UploadVideo(self, path: str) -> Tuple[str, int]:
-        """上传视频
+    async def UploadVideoAsync(
+        self, path: str, weight: float = 1, priority: int = BandwidthGovernor.PRIORITY_NORMAL
+    ) -> Tuple[str, int]:
+        """上传视频 (asyncio)，可并发上传多个视频
+
+        设置 `UPLOAD_JOURNAL` 后，中断的上传将在会话有效期内断点续传；
+        设置 `UPLOAD_INDEX` 后，有效期内已上传过的相同文件将直接返回其上传结果；
+        结点状况不佳时将切换至其他 CDN 重新上传 （至多 `UPLOAD_FAILOVERS` 次）
+        已由 `PrefetchUpload` / `StreamUpload` 开始握手或上传的视频，将直接取用其结果
 
         Args:
-            path (str): 视频文件路径
+            path (str): 视频文件路径，亦可为 URL (http(s)://，s3://) 或 `UploadSource`
+            weight (float, optional): 并发上传时的调度权重. Defaults to 1.
+            priority (int, optional): 带宽限速时的优先级，越小越优先. Defaults to PRIORITY_NORMAL.
 
         Returns:
             Tuple[str,str]: [远端 URI,biz_id]
         """
+        streamed = await self._take_stream(path)
+        if streamed:
+            return streamed
         path, basename, size = check_file(path)
+        loop = asyncio.get_running_loop()
+        index_key, indexed = await self._take_indexed(path)
+        if indexed:
+            return indexed
+
+        tried_cdns = set()
+        prefetched = await self._take_handshake(path)
 
-        def generate_upload_chunks(name, size):
-            def fetch_upload_id():
-                """Generating uplaod chunks"""
-                for i in range(1, self.RETRIES_UPLOAD_ID + 1):
-                    try:
-                        config = self._preupload(name=name, size=size).json()
-                        self.headers["X-Upos-Auth"] = config["auth"]
-                        """X-Upos-Auth header"""
-                        endpoint = "https:%s/%s" % (
-                            config["endpoint"],
-                            config["upos_uri"].split('upos://')[-1]
-                        )
-                        self.logger.info("远端结点： %s" % endpoint)
-                        self.logger.debug("第 %s 次刷新 TOKEN..." % i)
-                        # https://upos-cs-upcdnbda2.bilivideo.com/ugcfx2lf/
-                        # n220728a288v9obhmjrsgy8g3mf0rpuu.mp4?
-                        # uploads&output=json&profile=ugcfx%2Fbup&filesize=1008319211&
-                        # partsize=10485760&
-                        # meta_upos_uri=upos%3A%2F%2Ffxmeta%2Fn220728a2uy50rqfrx1kz2xenwwshgaq.txt&biz_id=786176430
-                        #
-                        resp = self._upload_id(endpoint)
-                        upload_id = resp.json()["upload_id"]
-                        return config, endpoint, upload_id
-                    except Exception as e:
-                        self.logger.warning("第 %s 上传时：%s (HTTP %s)" % (i,e,resp.status_code))
-                        time.sleep(self.DELAY_RETRY_UPLOAD_ID)
-                return None, None, None
-
-            config, endpoint, upload_id = fetch_upload_id()
-            if not upload_id:
-                raise Exception("经 %s 次重试后仍无法获取 TOKEN" % self.RETRIES_UPLOAD_ID)
-            """Upload endpoint & keys"""
+        def create_job(config, endpoint, parts_done):
+            upload_id = config["upload_id"]
             chunksize = config["chunk_size"]
             chunkcount = math.ceil(size / chunksize)
-            file_manager.open(path)
+            job = UploadJob(path, weight, priority)
+            job.headers["X-Upos-Auth"] = config["auth"]
+            """X-Upos-Auth header,owned by this upload only"""
             self.logger.debug("上传分块: %s" % chunkcount)
             self.logger.debug("分块大小: %s B" % chunksize)
 
@@ -393,6 +837,9 @@ class BiliSession(Session):
                 for chunk_n in range(0, chunkcount):
                     start = chunksize * chunk_n
                     end = min(start + chunksize, size)
+                    if chunk_n + 1 in parts_done:
+                        job.file_manager.account(path, end - start)
+                        continue
                     chunk = WebUploadChunk(path, start, end)
                     chunk.url_endpoint = endpoint
                     chunk.session = self
@@ -405,26 +852,85 @@ class BiliSession(Session):
                         "end": end,
                         "total": size,
                     }
-                    chunk.headers = {"X-Upos-Auth": config["auth"]}
+                    chunk.headers = job.headers
                     yield chunk
 
-            config["upload_id"] = upload_id
-            return endpoint, config, iter_chunks()
+            job.open()
+            return job.extend(iter_chunks())
 
-        endpoint, config, chunks = generate_upload_chunks(basename, size)
-        """Generates upload config"""
-        self._upload_chunks_to_endpoint_blocking(chunks)
+        def journal_part(chunk):
+            try:
+                journal.complete_part(journal_key, chunk.params["partNumber"])
+            except Exception as e:
+                self.logger.warning("无法记录上传进度：%s" % e)
+
+        journal, journal_key = self.upload_journal, None
+        resumed, parts_done = None, set()
+        if journal:
+            journal_key = journal.key(path, self.UPLOAD_PROFILE)
+            resumed, parts_done = journal.lookup(journal_key)
+        for failover in range(self.UPLOAD_FAILOVERS + 1):
+            if resumed:
+                config, endpoint = resumed["config"], resumed["endpoint"]
+                self.logger.info("继续上传 %s ：已完成 %s 个分块" % (basename, len(parts_done)))
+            elif prefetched and not failover:
+                config, endpoint = prefetched
+                if journal:
+                    journal.begin(journal_key, {"config": config, "endpoint": endpoint})
+            else:
+                try:
+                    config, endpoint = await self._handshake_with_retry(path, tried_cdns)
+                except Exception as e:
+                    raise Exception("经 %s 次重试后仍无法获取 TOKEN：%s" % (self.RETRIES_UPLOAD_ID, e))
+                if journal:
+                    journal.begin(journal_key, {"config": config, "endpoint": endpoint})
+            job = create_job(config, endpoint, parts_done)
+            job.failover = self.UPLOAD_FAILOVER and failover < self.UPLOAD_FAILOVERS
+            if journal:
+                job.on_part_done.append(journal_part)
+            try:
+                await self._upload_chunks_to_endpoint(job)
+                break
+            except UploadAborted:
+                # the new node needs every part again
+                self.logger.warning("切换 CDN 重新上传 %s" % basename)
+                tried_cdns.add(config.get("upcdn"))
+                resumed, parts_done = None, set()
+            finally:
+                job.close()
         """Wait for current upload to finish"""
-        file_manager.close(path)
-        state = self._upload_status(
-            endpoint, basename, config["upload_id"], config["biz_id"]
+        state = await loop.run_in_executor(
+            None,
+            self._upload_status,
+            endpoint,
+            basename,
+            config["upload_id"],
+            config["biz_id"],
+            config["auth"],
         )
+        if journal and (state["OK"] == 1 or not job.parts_failed):
+            # done,or the upload session is no longer valid
+            journal.finish(journal_key)
         if state["OK"] == 1:
             self.logger.debug("上传完毕: %s" % ReprExDict(state))
         else:
             raise Exception("上传失败: %s" % ReprExDict(state))
+        self._record_indexed(index_key, (endpoint, config["biz_id"]))
         return endpoint, config["biz_id"]
 
+    def UploadVideo(
+        self, path: str, weight: float = 1, priority: int = BandwidthGovernor.PRIORITY_NORMAL
+    ) -> Tuple[str, int]:
+        """上传视频，`UploadVideoAsync` 的同步版本
+
+        Args:
+            path (str): 视频文件路径，亦可为 URL (http(s)://，s3://) 或 `UploadSource`
+
+        Returns:
+            Tuple[str,str]: [远端 URI,biz_id]
+        """
+        return self._run_blocking(self.UploadVideoAsync(path, weight, priority))
+
     def _upload_cover(self, image_binary: bytes, image_mime: str):
         return self.post(
             "https://member.bilibili.com/x/vu/web/cover/up",
@@ -451,6 +957,29 @@ class BiliSession(Session):
             params={"csrf": self.cookies.get("bili_jct")},
         )
 
+    def _submit_submission_with_retry(self, submission: Submission):
+        """submits `submission`,backing off while rate-limited"""
+
+        def submit():
+            result = self._submit_submission(submission).json()
+            if result["code"] in self.SUBMISSION_RATE_LIMITED_CODES:
+                self.logger.warning("请求受限（限流），准备重试")
+                raise SubmissionRateLimited(result)
+            return result
+
+        policy = RetryPolicy(
+            self.RETRIES_VIDEO_SUBMISSION,
+            self.DELAY_VIDEO_SUBMISSION,
+            max(self.DELAY_VIDEO_SUBMISSION, self.DELAY_RETRY_MAX),
+        )
+        try:
+            # submitting isn't idempotent,so only what surely wasn't accepted is sent again.
+            # no circuit breaker either : rate limiting isn't the endpoint failing
+            return policy.run(submit, retry_on=SubmissionRateLimited)
+        except SubmissionRateLimited as e:
+            self.logger.error("重试次数达到上限")
+            return e.result
+
     def SubmitSubmission(self, submission: Submission, seperate_parts=False):
         """提交作品，适用于初次上传；否则请使用 `EditSubmission`
 
@@ -460,29 +989,18 @@ class BiliSession(Session):
         """
         if not seperate_parts:
             self.logger.debug("准备提交多 P 内容: %s" % submission.title)
-            result = self._submit_submission(submission).json()
+            result = self._submit_submission_with_retry(submission)
             return {"code:": result["code"], "results": [result]}
         else:
             results = []
             codes = 0
             for submission in submission.videos:
                 self.logger.debug("准备提交单 P 内容: %s" % submission.title)
-                success_flag = False
-                for i in range(0,max(self.RETRIES_UPLOAD_ID,1)):
-                    result = self._submit_submission(submission).json()
-                    if result["code"] in {21070, 21186}:
-                        self.logger.warning("请求受限（限流），准备重试")
-                        time.sleep(self.DELAY_VIDEO_SUBMISSION)
-                        continue
-                    elif result["code"] != 0:
-                        self.logger.error(
-                            "其他错误 (%s): %s - 跳过上传" % (result["code"], result["message"])
-                        )
-                        break
-                    else:
-                        success_flag = True
-                    if not success_flag:
-                        self.logger.error("重试次数达到上限")
+                result = self._submit_submission_with_retry(submission)
+                if result["code"] != 0:
+                    self.logger.error(
+                        "其他错误 (%s): %s - 跳过上传" % (result["code"], result["message"])
+                    )
                 codes += result["code"]  # we want to see if its 0 or else
                 results.append(result)
             return {"code": codes, "results": results}
@@ -31,10 +31,36 @@ global_args = {
     "http": {"help": "强制使用 HTTP （不推荐）", "default": False, "action": "store_true"},
     "noenv": {"help": "上传时，不采用环境变量（如代理）", "default": False, "action": "store_true"},
     "cdn": {
-        "help": "上传用 CDN （限 Web API) （对应 网宿（适合海外），七牛，百度（默认），七牛，谷歌，百度）",
-        "choices": ["ws", "qn", "bda2", "kodo", "gcs", "bos"],
+        "help": "上传用 CDN （限 Web API) （对应 网宿（适合海外），七牛，百度（默认），七牛，谷歌，百度；auto 为测速后自动选择）",
+        "choices": ["ws", "qn", "bda2", "kodo", "gcs", "bos", "auto"],
         "default": "bda2",
     },
+    "source_addresses": {"help": "上传时，分块分散使用的本地地址（多出口聚合带宽） e.g. 192.168.1.2,10.0.0.2"},
+    "limit_upload": {"help": "上传带宽上限 e.g. 2M （即 2 MB/s）", "default": ""},
+    "limit_download": {"help": "下载带宽上限 e.g. 10M （即 10 MB/s）", "default": ""},
+    "bandwidth_schedule": {
+        "help": "分时段带宽上限，覆盖以上设置 e.g. 09:00-18:00=1M/10M,18:00-09:00=/ （上传/下载，留空不限）",
+        "default": "",
+    },
+    "processes": {"help": "上传时，将分块分散至多个进程上传（适合多核、高带宽主机）", "default": 1, "type": int},
+    "memory_budget": {"help": "上传分块占用内存上限 e.g. 64M", "default": "64M"},
+    "stream_upload": {
+        "help": "边下边传：已知最终大小的视频（不需合并、转码）在下载开始时即开始上传",
+        "default": False,
+        "action": "store_true",
+    },
+    "prefetch": {
+        "help": "上传时，由后台线程预读将要上传的分块（适合机械硬盘、网络存储）",
+        "default": False,
+        "action": "store_true",
+    },
+    "journal": {"help": "上传时，记录上传进度至该文件，中断后可断点续传（限 Web API）"},
+    "dedupe": {"help": "上传时，记录已上传文件的指纹至该文件，有效期内相同文件不再重复上传"},
+    "dedupe_full_hash": {
+        "help": "去重时，以完整文件内容计算指纹（较慢，默认仅抽样部分数据块）",
+        "default": False,
+        "action": "store_true",
+    },
     "retry_submit_delay" : {"help": "投稿限流时，重新投稿周期", "default": 30},
     "retry_submit_count" : {"help": "投稿限流时，尝试重新投稿次数", "default": 5},
 }
@@ -113,12 +139,6 @@ def prepare_temp(temp_path: str):
     return True
 
 
-def report_progress(current, max_val):
-    from bilibili_toolman.cli import precentage_progress
-
-    precentage_progress.report(current, max_val)
-
-
 def _enumerate_providers():
     provider_dict = dict()
     for provider in dir(providers):
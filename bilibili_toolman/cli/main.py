@@ -2,6 +2,11 @@
 from bilibili_toolman.bilisession.web import BiliSession
 from bilibili_toolman.bilisession.client import RecaptchaRequiredException
 from bilibili_toolman.bilisession.common import LoginException
+from bilibili_toolman.bilisession.common import FileManager, parse_size
+from bilibili_toolman.bilisession.common.bandwidth import governor
+from bilibili_toolman.bilisession.common.buffers import buffer_pool
+from bilibili_toolman.bilisession.common.progress import progress_bus
+from bilibili_toolman.bilisession.common.service import upload_service
 from bilibili_toolman.bilisession.common.submission import Submission
 from bilibili_toolman.providers import DownloadResult
 from bilibili_toolman.cli import (
@@ -15,7 +20,7 @@ from bilibili_toolman.cli import (
 )
 
 from collections import defaultdict
-import logging, sys, urllib.parse
+import logging, os, sys, urllib.parse
 
 TEMP_PATH = "temp"
 
@@ -90,30 +95,35 @@ def upload_sources(sources: DownloadResult, arg):
         )
         return blocks, title, description
 
-    for source in sources.results:
+    for index, source in enumerate(sources.results):
         """If one or multipule sources"""
         blocks, title, description = format(source)
         logger.info("准备上传: %s" % title)
         """Summary trimming"""
         endpoint = None
-        for _ in range(0, sess_upload.RETRIES_UPLOAD_ID):
+        if index + 1 < len(sources.results):
+            """Handshakes for the next video while this one uploads"""
             try:
-                endpoint, bid = sess_upload.UploadVideo(source.video_path)
-                cover_url = (
-                    sess_upload.UploadCover(source.cover_path)["data"]["url"]
-                    if source.cover_path
-                    else ""
-                )
-                break
+                sess_upload.PrefetchUpload(sources.results[index + 1].video_path)
             except Exception as e:
-                logger.warning("%s 上传失败! - %s - 重试" % (source, e))
+                logger.debug("无法预先握手 - %s" % e)
+
+        try:
+            endpoint, bid = sess_upload.UploadVideo(source.video_path)
+        except Exception as e:
+            logger.warning("%s 上传失败! - %s" % (source, e))
         if not endpoint:
             logger.error("URI 获取失败 - 跳过")
             continue
+        cover_url = ""
+        if source.cover_path:
+            try:
+                cover_url = sess_upload.upload_retry_policy.run(
+                    sess_upload.UploadCover, source.cover_path
+                )["data"]["url"]
+            except Exception as e:
+                logger.warning("%s 封面上传失败，不使用封面 - %s" % (source, e))
         logger.info("资源已上传")
-        from bilibili_toolman.cli import precentage_progress
-
-        precentage_progress.close()
         with Submission() as video:
             """Creatating a video per submission"""
             video.cover_url = cover_url
@@ -171,6 +181,13 @@ def upload_sources(sources: DownloadResult, arg):
             else:
                 logger.warning("%s 上传失败 : %s" % (submission, result["message"]))
                 dirty = True
+        if dirty:
+            """The uploads may be what got rejected,so they're redone next time"""
+            for video in sources.results:
+                try:
+                    sess_upload.ForgetUpload(video.video_path)
+                except Exception as e:
+                    logger.debug("无法移除上传记录 - %s" % e)
         return submit_result, dirty
     else:
         logger.warning("已跳过稿件提交")
@@ -189,6 +206,16 @@ def setup_session():
         if global_args.http:
             logger.warning("强制使用 HTTP")
             sess.FORCE_HTTP = True
+        if global_args.source_addresses:
+            sess.UPLOAD_SOURCE_ADDRESSES = tuple(
+                address.strip() for address in global_args.source_addresses.split(",")
+            )
+        sess.UPLOAD_PROCESSES = max(global_args.processes, 1)
+        if global_args.journal:
+            sess.UPLOAD_JOURNAL = os.path.abspath(global_args.journal)
+        if global_args.dedupe:
+            sess.UPLOAD_INDEX = os.path.abspath(global_args.dedupe)
+            sess.UPLOAD_INDEX_FULL_HASH = global_args.dedupe_full_hash
         if global_args.noenv:
             logger.warning("不使用环境变量；请求将绕过代理")
             sess.trust_env = False
@@ -264,6 +291,9 @@ def __main__():
     global global_args, local_args
     global sess_submit, sess_upload
     setup_logging()
+    from bilibili_toolman.cli import precentage_progress
+
+    progress_bus.subscribe(precentage_progress.report)
     args = prase_args(sys.argv)
     if args:
         global_args, local_args = args
@@ -288,16 +318,28 @@ def __main__():
                 "gcs",
                 "bos",
             }  # TODO : Actually implementing bupfetch routes
-            if global_args.cdn in bup:
+            if global_args.cdn == "auto":
                 sess.UPLOAD_PROFILE = "ugcupos/bup"
-            elif global_args.cdn in bupfetch:
-                sess.UPLOAD_PROFILE = "ugcupos/bupfetch"
-            sess.UPLOAD_CDN = global_args.cdn
+                sess.UPLOAD_CDN_AUTO = True
+            else:
+                if global_args.cdn in bup:
+                    sess.UPLOAD_PROFILE = "ugcupos/bup"
+                elif global_args.cdn in bupfetch:
+                    sess.UPLOAD_PROFILE = "ugcupos/bupfetch"
+                sess.UPLOAD_CDN = global_args.cdn
             logger.info("Web 端 API @ ID:%s" % sess.Self["data"]["uname"])
-            logger.debug("CDN ： %s [%s]" % (sess.UPLOAD_CDN, sess.UPLOAD_PROFILE))
+            logger.debug(
+                "CDN ： %s [%s]"
+                % ("auto" if sess.UPLOAD_CDN_AUTO else sess.UPLOAD_CDN, sess.UPLOAD_PROFILE)
+            )
         elif sess.TYPE == "client":  # using client APIs
             logger.info("上传助手 API @ MID:%s" % sess.mid)
 
+    buffer_pool.budget = int(parse_size(global_args.memory_budget))
+    FileManager.PREFETCH = global_args.prefetch
+    governor.set_limits(global_args.limit_upload, global_args.limit_download)
+    if global_args.bandwidth_schedule:
+        governor.parse_schedule(global_args.bandwidth_schedule)
     prepare_temp(TEMP_PATH)
     # Output current settings
     logger.info("任务总数: %s" % len(local_args))
@@ -312,7 +354,16 @@ def __main__():
         logger.info("任务信息：")
         for k, v in largs.items():
             logger.info("  - %s : %s" % (list(v.values())[0].split()[0], fmt(arg[k])))
-        sources = download_sources(provider, arg)
+        stream_hooks = getattr(provider, "stream_hooks", None)
+        if not (global_args.stream_upload and not arg.no_upload):
+            stream_hooks = None
+        if stream_hooks is not None:
+            stream_hooks.append(sess_upload.StreamUpload)
+        try:
+            sources = download_sources(provider, arg)
+        finally:
+            if stream_hooks is not None:
+                stream_hooks.remove(sess_upload.StreamUpload)
         if arg.no_upload:
             logger.warn("已跳过上传")
         else:
@@ -321,6 +372,8 @@ def __main__():
                 success.append((arg, result))
             else:
                 failure.append((arg, None))
+        sess_upload.CancelStreamUploads()
+    upload_service.shutdown()
 
     if not failure:
         logger.info("任务完毕")
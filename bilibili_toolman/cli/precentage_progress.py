@@ -1,21 +1,35 @@
 # -*- coding: utf-8 -*-
+import os
+from bilibili_toolman.bilisession.common.progress import ProgressBus, ProgressTracker
+
 try:
     from tqdm import tqdm
-
-    tqdm_ = tqdm(unit="B", unit_scale=True, maxinterval=0)
-    # setting maxinterval=0 to disable tqdm's internal monitor
 except:
-    tqdm_ = None
-
+    tqdm = None
 
-def report(current, max):
-    if tqdm is not None:
-        tqdm_.total = max
-        tqdm_.n = current
-        tqdm_.refresh()
+tracker = ProgressTracker()
+bars = dict()
 
 
-def close():
-    # silence tqdm
-    if tqdm is not None:
-        tqdm_.disable = True
+def report(event):
+    """`progress_bus` subscriber,one progress bar per file being uploaded"""
+    job = event.job
+    if event.kind == ProgressBus.JOB_DONE and job in bars:
+        bar = bars.pop(job)
+        bar.update(tracker.progress(job) - bar.n)
+        bar.close()
+    tracker(event)
+    if tqdm is None:
+        return
+    if event.kind == ProgressBus.JOB_START and job not in bars:
+        bars[job] = tqdm(
+            desc=os.path.basename(job.path),
+            total=job.size,
+            unit="B",
+            unit_scale=True,
+            maxinterval=0,
+        )
+        # setting maxinterval=0 to disable tqdm's internal monitor
+    if job in bars:
+        bar = bars[job]
+        bar.update(tracker.progress(job) - bar.n)
@@ -36,3 +36,4 @@ class DownloadResult:
 
 from bilibili_toolman.providers import youtube as provider_youtube
 from bilibili_toolman.providers import localfile as provider_localfile
+from bilibili_toolman.providers import remotefile as provider_remotefile
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Remote file provider - uploads straight from HTTP(S) / S3 storage without downloading"""
+from bilibili_toolman.bilisession.common.sources import HTTPSource, S3Source
+from bilibili_toolman.providers import DownloadResult
+
+__desc__ = "远程文件（HTTP(S) 或 S3，分块按 Range 读取后直接上传，不落盘）"
+__cfg_help__ = """
+    cover (str) - 封面图片路径
+    endpoint (str) - S3 服务地址 (默认 $AWS_ENDPOINT_URL)
+    region (str) - S3 区域 (默认 $AWS_REGION)
+    凭据取自 AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY 环境变量，多个 URL 用 , 隔开
+e.g. --remotefile "s3://bucket/a.mp4,s3://bucket/b.mp4" --opts endpoint=http://127.0.0.1:9000 --tags ..."""
+options = {"cover": "", "endpoint": "", "region": ""}
+
+
+def update_config(opt):
+    global options
+    options = {**options, **opt}
+
+
+def download_video(res) -> DownloadResult:
+    results = DownloadResult()
+
+    def append(url):
+        if url.startswith("s3://"):
+            source = S3Source(url, options["endpoint"] or None, options["region"] or None)
+        else:
+            source = HTTPSource(url)
+        source.open()  # fails early on sources that can't be read by range
+        with DownloadResult() as result:
+            result.video_path = source
+            result.cover_path = options["cover"]
+            result.title = source.name
+            result.soruce = "bilibili-toolman"
+            result.description = "[automated upload of %s]" % url
+        results.results.append(result)
+
+    for url in filter(None, (url.strip() for url in res.split(","))):
+        append(url)
+    results.title = results.results[0].title if results.results else res
+    results.soruce = "bilibili-toolman"
+    results.description = "[automated upload of %s]" % res
+    return results
@@ -12,6 +12,7 @@ from yt_dlp.utils import (
     datetime_from_str,
 )
 from yt_dlp.version import __version__ as yt_dlp_version
+from bilibili_toolman.bilisession.common.bandwidth import governor
 from bilibili_toolman.providers import DownloadResult
 import logging, yt_dlp, os, subprocess, sys
 
@@ -56,6 +57,45 @@ e.g. --youtube "..." --opts "format=best&quiet=True&hardcode" --tags ...
 """
 ydl = None
 logger = logging.getLogger("yt-dlp")
+downloaded = dict()
+"""Bytes downloaded so far per file,as last reported to `throttle_download`"""
+stream_hooks = []
+"""Called with (final path, final size, partial path) as soon as a download starts whose
+final file is the downloaded one as-is and whose size is known, e.g. to upload it meanwhile"""
+announced = set()
+hardcoding = False
+
+
+def throttle_download(status):
+    """yt-dlp progress hook drawing downloaded bytes from the process-wide bandwidth governor"""
+    filename = status.get("filename")
+    if status.get("status") != "downloading":
+        downloaded.pop(filename, None)
+        return
+    done = status.get("downloaded_bytes") or 0
+    last = downloaded.get(filename, 0)
+    downloaded[filename] = done
+    governor.acquire(governor.DOWN, done - last if done >= last else done)
+
+
+def announce_download(status):
+    """yt-dlp progress hook calling `stream_hooks` once for every download of a known final size"""
+    filename, total = status.get("filename"), status.get("total_bytes")
+    if status.get("status") != "downloading" or not stream_hooks or not total or filename in announced:
+        return
+    announced.add(filename)
+    info = status.get("info_dict") or {}
+    if hardcoding or info.get("requested_formats"):
+        return  # to be merged or re-encoded afterwards
+    if filename != "%s.%s" % (info.get("display_id"), info.get("ext")):
+        return
+    for hook in stream_hooks:
+        try:
+            hook(filename, total, status.get("tmpfilename"))
+        except Exception as e:
+            logger.warning("无法边下边传：%s" % e)
+
+
 yt_dlp.utils.std_headers[
     "User-Agent"
 ] = "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"
@@ -65,7 +105,8 @@ params = {
     "format": "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",
     "writethumbnail": True,
     "writesubtitles": True,
-    "ignoreerrors":True
+    "ignoreerrors":True,
+    "progress_hooks": [throttle_download, announce_download],
 }  # default params,can be overridden
 
 
@@ -74,7 +115,7 @@ def __to_yyyy_mm_dd(date):
 
 
 def update_config(cfg):
-    global ydl
+    global ydl, hardcoding
     # preprocess some parameters
     if "daterange" in cfg:
         datestr = cfg["daterange"]
@@ -97,6 +138,7 @@ def update_config(cfg):
         cfg["playlistbegin"] = int(cfg["playlistbegin"])
 
     hardcodeSettings = None
+    hardcoding = "hardcode" in cfg
     if "hardcode" in cfg:  # private implementation of hardcoding subtitles
         hardcodeSettings = HardcodeSettings(from_cmd=cfg["hardcode"])
         del cfg["hardcode"]
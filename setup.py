@@ -23,5 +23,5 @@ setuptools.setup(
     entry_points={
         "console_scripts": ["bilibili-toolman=bilibili_toolman.cli.main:__main__"]
     },
-    python_requires=">=3.6",
+    python_requires=">=3.7",
 )